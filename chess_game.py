@@ -5,6 +5,8 @@ import tensorflow as tf
 import numpy as np
 import json
 
+from scripts.board_encoding import board_to_tensor
+
 # Initialize Pygame
 pygame.init()
 
@@ -42,7 +44,7 @@ for piece in PIECES:
 board = chess.Board()
 
 # Load the AI model and move dictionaries
-model = tf.keras.models.load_model('/home/santosh/chess_engine-1/data/chess_ai_model .h5')  # Load the trained model
+model = tf.keras.models.load_model('/home/santosh/chess_engine-1/data/chess_ai_model .h5', compile=False)  # Load the trained model (inference only, so its training loss is not needed)
 with open('/home/santosh/chess_engine-1/data/move_dict .json', 'r') as f:
     move_dict = json.load(f)
 with open('/home/santosh/chess_engine-1/data/reverse_move_dict .json', 'r') as f:
@@ -50,17 +52,6 @@ with open('/home/santosh/chess_engine-1/data/reverse_move_dict .json', 'r') as f
 
 # Function to predict the AI's move using the neural network
 def predict_ai_move(board):
-    def board_to_tensor(board):
-        tensor = np.zeros((12, 8, 8), dtype=np.float32)
-        piece_map = {chess.PAWN: 0, chess.KNIGHT: 1, chess.BISHOP: 2, chess.ROOK: 3, chess.QUEEN: 4, chess.KING: 5}
-        for square in chess.SQUARES:
-            piece = board.piece_at(square)
-            if piece:
-                piece_type = piece_map[piece.piece_type]
-                color = 0 if piece.color == chess.WHITE else 1
-                tensor[color * 6 + piece_type][7 - chess.square_rank(square)][chess.square_file(square)] = 1
-        return tensor.flatten()
-    
     board_tensor = board_to_tensor(board)
     board_tensor = np.expand_dims(board_tensor, axis=0)  # Add batch dimension
     predictions = model.predict(board_tensor)[0]  # Get predictions
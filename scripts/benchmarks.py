@@ -0,0 +1,411 @@
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import sys
+import tempfile
+import time
+
+import chess
+import chess.pgn
+import numpy as np
+
+from board_encoding import board_bitboards, board_to_tensor, encode_boards_into, get_encode_buffer, set_board_from_fen
+from data_preprocessing import PositionBuffer, encode_game_into, iter_encoded_batches, read_encoded_game, save_dataset
+from dataset_shards import load_manifest
+from pgn_index import build_pgn_index, load_pgn_index, verify_pgn_index
+from pgn_sources import open_pgn
+
+RESULTS_VERSION = 1
+PIPELINE_STAGES = ("read", "parse", "encode", "label", "write")
+
+# FENs set_board_from_fen must set up or reject exactly like Board.set_fen
+EDGE_CASE_FENS = (
+    "r3k2r/8/8/8/8/8/8/R3K2R w KQkq - 0 1",
+    "r3k2r/8/8/8/8/8/8/R3K2R w KK - 0 1",  # Repeated right
+    "r3k2r/8/8/8/8/8/8/R3K2R w kqKQ - 0 1",  # Rights out of order
+    "4k3/8/8/8/8/8/8/4K1R1 w Kq - 0 1",  # Rights without their corner rook
+    "rk5r/8/8/8/8/8/8/RK5R w HAha - 0 1",  # Shredder-FEN
+    "4k3/8/8/8/8/8/8/4K3 w - - 0 1 extra",  # Extra field
+    "4k3/8/8/8/8/8/8/4K3 w - - 0 0",
+    "4k3/8/8/8/8/8/8/4K3 w - - -1 1",
+    "4k3/8/8/8/8/8/8/4K3 w - - x 1",
+    "4k3/8/8/8/8/8/8/4K3 b - e3",
+    "4k3/8/8/8/8/8/8/4K3 w -",
+    "4k3/8/44/8/8/8/8/4K3 w - - 0 1",  # Two digits in a row
+    "4k3/8/8/8/8/8/8/4Q~K2 w - - 0 1",  # Promoted piece marker
+    "4k3/8/8/8/8/8/8/4K3 x - - 0 1",
+    "4k3/8/8/8/8/8/4K3 w - - 0 1",
+)
+
+
+# Reference encoder: the square-by-square implementation board_to_tensor replaced
+def board_to_tensor_reference(board):
+    tensor = np.zeros((12, 8, 8), dtype=np.float32)
+    piece_map = {chess.PAWN: 0, chess.KNIGHT: 1, chess.BISHOP: 2, chess.ROOK: 3, chess.QUEEN: 4, chess.KING: 5}
+    for square in chess.SQUARES:
+        piece = board.piece_at(square)
+        if piece:
+            piece_type = piece_map[piece.piece_type]
+            color = 0 if piece.color == chess.WHITE else 1
+            tensor[color * 6 + piece_type][7 - chess.square_rank(square)][chess.square_file(square)] = 1
+    return tensor.flatten()
+
+
+# Function to generate positions from random games with a fixed seed
+def random_positions(num_positions, seed=0):
+    rng = random.Random(seed)
+    positions = []
+    board = chess.Board()
+    while len(positions) < num_positions:
+        moves = list(board.legal_moves)
+        if not moves or board.ply() >= 200:
+            board = chess.Board()
+            continue
+        board.push(rng.choice(moves))
+        positions.append(board.copy(stack=False))
+    return positions
+
+
+# Function to generate a PGN text of random games with a fixed seed, annotated like a Lichess export
+# (%eval and %clk comments on every move, and the occasional variation)
+def synthetic_pgn(num_games, seed=0):
+    rng = random.Random(seed)
+    games = []
+    for _ in range(num_games):
+        game = chess.pgn.Game()
+        game.headers["Event"] = "Rated Blitz game"
+        game.headers["WhiteElo"] = str(rng.randint(1200, 2600))
+        game.headers["BlackElo"] = str(rng.randint(1200, 2600))
+        game.headers["TimeControl"] = "180+2"
+        node = game
+        board = chess.Board()
+        for ply in range(rng.randint(20, 120)):
+            moves = list(board.legal_moves)
+            if not moves:
+                break
+            if ply % 15 == 7:
+                node.add_variation(rng.choice(moves)).comment = "[%eval 0.0]"
+            move = rng.choice(moves)
+            node = node.add_main_variation(move)
+            node.comment = f"[%eval {rng.uniform(-3, 3):.2f}] [%clk 0:{2 - ply // 60}:{59 - ply % 60:02d}]"
+            board.push(move)
+        game.headers["Result"] = board.result(claim_draw=False) if board.is_game_over() else "*"
+        games.append(str(game))
+    return "\n\n".join(games) + "\n"
+
+
+# Function to time an encoder over a list of positions and return positions/sec
+def time_encoder(encode, positions, repeat=3):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for board in positions:
+            encode(board)
+        best = min(best, time.perf_counter() - start)
+    return len(positions) / best
+
+
+# Benchmark the board encoder against the reference implementation
+def benchmark_encoding(num_positions):
+    positions = random_positions(num_positions)
+    for board in positions:
+        if not np.array_equal(board_to_tensor(board), board_to_tensor_reference(board)):
+            raise AssertionError(f"Encoders disagree on {board.fen()}")
+
+    before = time_encoder(board_to_tensor_reference, positions)
+    after = time_encoder(board_to_tensor, positions)
+    print(f"board_to_tensor (square by square): {before:12,.0f} positions/sec")
+    print(f"board_to_tensor (bitboards):        {after:12,.0f} positions/sec ({after / before:.1f}x)")
+
+    buffer = get_encode_buffer(None, len(positions))
+    batched = time_encoder(lambda batch: encode_boards_into(batch, buffer), [positions]) * len(positions)
+    print(f"encode_boards_into (batched):       {batched:12,.0f} positions/sec ({batched / before:.1f}x)")
+
+
+# Function to set up a board from a FEN, returning what defines the position (or the error)
+def fen_outcome(set_fen, fen):
+    board = chess.Board()
+    try:
+        set_fen(board, fen)
+    except ValueError:
+        return ValueError
+    return board.fen(en_passant="fen"), board.castling_rights, board.promoted, board.chess960
+
+
+# Benchmark setting up boards from FENs with set_board_from_fen against Board.set_fen, checking that both
+# give the same positions (and reject the same FENs), on game positions as FENs and EPD fields and edge cases
+def benchmark_fen_parsing(num_positions):
+    fens = [board.fen() for board in random_positions(num_positions)]
+    fens += [" ".join(fen.split()[:4]) for fen in fens[::2]] + list(EDGE_CASE_FENS)
+    for fen in fens:
+        fast, reference = fen_outcome(set_board_from_fen, fen), fen_outcome(chess.Board.set_fen, fen)
+        if fast != reference:
+            raise AssertionError(f"set_board_from_fen and Board.set_fen disagree on {fen!r}: {fast} != {reference}")
+
+    fens = fens[:num_positions]
+    board = chess.Board()
+    timings = []
+    for set_fen in (chess.Board.set_fen, set_board_from_fen):
+        best = float("inf")
+        for _ in range(3):
+            start = time.perf_counter()
+            for fen in fens:
+                set_fen(board, fen)
+            best = min(best, time.perf_counter() - start)
+        timings.append(len(fens) / best)
+    print(f"Board.set_fen:                       {timings[0]:12,.0f} positions/sec")
+    print(f"set_board_from_fen:                  {timings[1]:12,.0f} positions/sec ({timings[1] / timings[0]:.1f}x)")
+
+
+# Function to parse and encode every game of a PGN text with GameBuilder trees or the MainlineEncoder
+# visitor, returning the buffered bitboards and labels and games/sec
+def parse_and_encode(pgn_text, visitor):
+    buffer = PositionBuffer()
+    pgn = io.StringIO(pgn_text)
+    start = time.perf_counter()
+    num_games = 0
+    while True:
+        if visitor:
+            if read_encoded_game(pgn, buffer) is None:
+                break
+        else:
+            game = chess.pgn.read_game(pgn)
+            if game is None:
+                break
+            encode_game_into(game, buffer)
+        num_games += 1
+    elapsed = time.perf_counter() - start
+    return buffer.bitboards[:buffer.rows], buffer.labels[:buffer.rows], num_games / elapsed
+
+
+# Function to get the PGN text of the first num_games games of a file, or of synthetic games
+def sample_pgn_text(num_games, pgn_file=None):
+    if not pgn_file:
+        return synthetic_pgn(num_games)
+    offsets = load_pgn_index(pgn_file)
+    with open(pgn_file, "rb") as f:
+        size = int(offsets[num_games]) if num_games < len(offsets) else -1
+        return f.read(size).decode("utf-8")
+
+
+# Benchmark parsing PGN into encoded positions with full game trees against the mainline visitor
+def benchmark_parsing(num_games, pgn_file=None):
+    pgn_text = sample_pgn_text(num_games, pgn_file)
+
+    bitboards_before, labels_before, before = parse_and_encode(pgn_text, visitor=False)
+    bitboards_after, labels_after, after = parse_and_encode(pgn_text, visitor=True)
+    if not (np.array_equal(bitboards_before, bitboards_after) and np.array_equal(labels_before, labels_after)):
+        raise AssertionError("GameBuilder and MainlineEncoder produced different positions")
+    print(f"read_game + mainline_moves:          {before:12,.0f} games/sec")
+    print(f"MainlineEncoder visitor:             {after:12,.0f} games/sec ({after / before:.1f}x)")
+
+
+# Benchmark building the game index, checking it against chess.pgn.read_headers on synthetic games joined
+# both by a blank line and, as after "cat a.pgn b.pgn", directly after the previous game's movetext
+def benchmark_indexing(num_games, pgn_file=None):
+    with tempfile.TemporaryDirectory() as directory:
+        if not pgn_file:
+            pgn_file = os.path.join(directory, "games.pgn")
+            halves = synthetic_pgn(num_games // 2, seed=1), synthetic_pgn(num_games - num_games // 2, seed=2)
+            with open(pgn_file, "w") as f:
+                f.write(halves[0].rstrip("\n") + "\n" + halves[1])
+        start = time.perf_counter()
+        offsets = build_pgn_index(pgn_file, os.path.join(directory, "games.pgnidx"))
+        elapsed = time.perf_counter() - start
+        problems = verify_pgn_index(pgn_file, offsets)
+        if problems:
+            raise AssertionError(f"Game index disagrees with read_headers: {'; '.join(problems)}")
+        print(f"build_pgn_index:                     {os.path.getsize(pgn_file) / elapsed / 1e6:12,.1f} MB/sec")
+
+
+# Visitor for the parse stage: parses and plays the mainline moves and only counts the positions
+class CountingVisitor(chess.pgn.BaseVisitor):
+    def __init__(self):
+        self.positions = 0
+
+    def begin_variation(self):
+        return chess.pgn.SKIP
+
+    def visit_move(self, board, move):
+        self.positions += 1
+
+    def result(self):
+        return self.positions
+
+
+# PositionBuffer for the encode stage: stores the bitboards of every position but no move labels
+class UnlabelledBuffer(PositionBuffer):
+    def append(self, board, move):
+        if self.rows == len(self.labels):
+            self.grow()
+        self.bitboards[self.rows] = board_bitboards(board)
+        self.rows += 1
+
+
+# Function to run the preprocessing pipeline on a PGN file up to and including one stage.
+# Returns the number of games and positions processed and the bytes written (write stage only)
+def run_pipeline_stage(stage, pgn_file, batch_positions, packed, output_dir):
+    games = positions = bytes_written = 0
+    if stage == "read":
+        with open_pgn(pgn_file) as pgn:
+            for line in pgn:
+                games += line.startswith("[Event ")
+    elif stage == "parse":
+        with open_pgn(pgn_file) as pgn:
+            while True:
+                visitor = CountingVisitor()
+                if chess.pgn.read_game(pgn, Visitor=lambda: visitor) is None:
+                    break
+                games += 1
+                positions += visitor.positions
+    elif stage == "encode":
+        buffer = UnlabelledBuffer(batch_positions, packed=packed)
+        with open_pgn(pgn_file) as pgn:
+            while read_encoded_game(pgn, buffer) is not None:
+                games += 1
+                if buffer.rows >= batch_positions:
+                    positions += len(buffer.encoded()["X"])
+                    buffer.clear()
+        positions += len(buffer.encoded()["X"])
+    else:
+        for arrays, num_games in iter_encoded_batches(pgn_file, batch_positions, packed=packed):
+            games += num_games
+            positions += len(arrays["y"])
+            if stage == "write":
+                save_dataset(**arrays, data_dir=output_dir)
+        if stage == "write":
+            dataset_dir = os.path.join(output_dir, "dataset")
+            bytes_written = sum(os.path.getsize(os.path.join(dataset_dir, entry["name"]))
+                                for shard in load_manifest(dataset_dir)["shards"] for entry in shard["files"].values())
+    return games, positions, bytes_written
+
+
+# Function to time one pipeline stage (best of repeat runs). Runs in a fresh process, so the reported
+# peak RSS belongs to this stage alone
+def time_pipeline_stage(stage, pgn_file, batch_positions, packed, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        output_dir = tempfile.mkdtemp(prefix="benchmark_write_")
+        try:
+            start = time.perf_counter()
+            games, positions, bytes_written = run_pipeline_stage(stage, pgn_file, batch_positions, packed, output_dir)
+            best = min(best, time.perf_counter() - start)
+        finally:
+            shutil.rmtree(output_dir, ignore_errors=True)
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    return {"seconds": best, "games": games, "positions": positions, "bytes_written": bytes_written,
+            "peak_rss_mb": peak_rss / 2 ** 20}
+
+
+# Benchmark the preprocessing pipeline stage by stage. Every stage runs the pipeline up to and including
+# it, so its own cost is the time it adds to the previous stage. Returns the results as a dict
+def benchmark_pipeline(num_games, pgn_file=None, packed=False, batch_positions=1 << 16, repeat=3):
+    sample_dir = tempfile.mkdtemp(prefix="benchmark_sample_")
+    try:
+        sample_file = os.path.join(sample_dir, "sample.pgn")
+        with open(sample_file, "w", encoding="utf-8") as f:
+            f.write(sample_pgn_text(num_games, pgn_file))
+
+        stages = {}
+        context = multiprocessing.get_context("spawn")
+        for stage in PIPELINE_STAGES:
+            with context.Pool(1) as pool:
+                stages[stage] = pool.apply(time_pipeline_stage, (stage, sample_file, batch_positions, packed, repeat))
+    finally:
+        shutil.rmtree(sample_dir, ignore_errors=True)
+
+    games, positions = stages["write"]["games"], stages["write"]["positions"]
+    bytes_per_position = stages["write"]["bytes_written"] / max(positions, 1)
+    previous = 0.0
+    for stage in PIPELINE_STAGES:
+        result = stages[stage]
+        result["stage_seconds"] = max(result["seconds"] - previous, 0.0)
+        result["games_per_sec"] = games / result["seconds"]
+        result["positions_per_sec"] = positions / result["seconds"]
+        previous = result["seconds"]
+        del result["games"], result["positions"], result["bytes_written"]
+
+    return {
+        "version": RESULTS_VERSION,
+        "config": {"games": num_games, "pgn": pgn_file or "synthetic", "packed": packed,
+                   "batch_positions": batch_positions, "repeat": repeat},
+        "machine": {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()},
+        "games": games,
+        "positions": positions,
+        "bytes_per_position": bytes_per_position,
+        "stages": stages,
+    }
+
+
+# Function to print pipeline benchmark results as a table
+def print_pipeline_results(results):
+    print(f"{results['games']} games, {results['positions']} positions, "
+          f"{results['bytes_per_position']:.1f} bytes per stored position")
+    print(f"{'stage':8} {'stage sec':>10} {'games/sec':>12} {'positions/sec':>14} {'peak RSS MB':>12}")
+    for stage, result in results["stages"].items():
+        print(f"{stage:8} {result['stage_seconds']:10.3f} {result['games_per_sec']:12,.0f} "
+              f"{result['positions_per_sec']:14,.0f} {result['peak_rss_mb']:12.1f}")
+
+
+# Function to compare pipeline results with a saved baseline. Returns the regressions beyond tolerance:
+# lower throughput, higher peak RSS or more bytes per stored position
+def compare_with_baseline(results, baseline, tolerance=0.1):
+    regressions = []
+    print(f"Compared with baseline ({baseline['machine']['platform']}, {baseline['config']['games']} games):")
+    for stage in PIPELINE_STAGES:
+        if stage in baseline["stages"]:
+            speed = results["stages"][stage]["positions_per_sec"] / baseline["stages"][stage]["positions_per_sec"]
+            memory = results["stages"][stage]["peak_rss_mb"] / baseline["stages"][stage]["peak_rss_mb"]
+            print(f"{stage:8} {speed:6.2f}x throughput {memory:6.2f}x peak RSS")
+            if speed < 1 - tolerance:
+                regressions.append(f"{stage}: throughput is {speed:.2f}x the baseline")
+            if memory > 1 + tolerance:
+                regressions.append(f"{stage}: peak RSS is {memory:.2f}x the baseline")
+
+    size = results["bytes_per_position"] / baseline["bytes_per_position"]
+    print(f"bytes per stored position: {size:.2f}x")
+    if size > 1 + tolerance:
+        regressions.append(f"bytes per stored position is {size:.2f}x the baseline")
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the preprocessing pipeline.")
+    parser.add_argument("--positions", type=int, default=20000, help="Number of positions to encode")
+    parser.add_argument("--games", type=int, default=500, help="Number of games to parse")
+    parser.add_argument("--pgn", default=None, help="Parse games from this PGN file instead of synthetic ones")
+    parser.add_argument("--pipeline", action="store_true",
+                        help="Benchmark the pipeline stages (read, parse, encode, label, write) instead")
+    parser.add_argument("--packed", action="store_true", help="Store bit-packed positions in the pipeline benchmark")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per pipeline stage (the best one counts)")
+    parser.add_argument("--json", default=None, help="Write the pipeline results to this JSON file")
+    parser.add_argument("--baseline", default=None, help="Compare the pipeline results with this JSON file")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed relative regression against the baseline")
+    args = parser.parse_args()
+
+    if args.pipeline:
+        results = benchmark_pipeline(args.games, args.pgn, args.packed, repeat=args.repeat)
+        print_pipeline_results(results)
+        if args.json:
+            with open(args.json, "w") as f:
+                json.dump(results, f, indent=1)
+        if args.baseline:
+            with open(args.baseline) as f:
+                regressions = compare_with_baseline(results, json.load(f), args.tolerance)
+            for regression in regressions:
+                print(f"REGRESSION {regression}")
+            if regressions:
+                sys.exit(1)
+    else:
+        benchmark_encoding(args.positions)
+        benchmark_fen_parsing(args.positions)
+        benchmark_parsing(args.games, args.pgn)
+        benchmark_indexing(args.games, args.pgn)
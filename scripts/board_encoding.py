@@ -0,0 +1,163 @@
+import functools
+import re
+
+import chess
+import numpy as np
+
+NUM_PLANES = 12  # 6 piece types for white, then 6 for black
+NUM_FEATURES = NUM_PLANES * 64
+PACKED_BYTES = NUM_FEATURES // 8  # 96 bytes per bit-packed position
+PIECE_TYPES = (chess.PAWN, chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN, chess.KING)
+
+
+# Function to get the 12 piece/color bitboards of a board (white pawns ... black king)
+def board_bitboards(board):
+    white, black = board.occupied_co[chess.WHITE], board.occupied_co[chess.BLACK]
+    pieces = (board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings)
+    return tuple(p & white for p in pieces) + tuple(p & black for p in pieces)
+
+
+# Plane of every FEN piece symbol, in board_bitboards order
+SYMBOL_PLANES = {symbol: plane for plane, symbol in enumerate("PNBRQKpnbrqk")}
+CASTLING_SQUARES = {"K": chess.BB_H1, "Q": chess.BB_A1, "k": chess.BB_H8, "q": chess.BB_A8}
+STANDARD_CASTLING_REGEX = re.compile(r"^(-|K?Q?k?q?)$")  # Each right at most once, in FEN order
+
+
+# Function to parse one rank of a board FEN (e.g. "2n5") into (plane, 8-bit file mask) pairs.
+# Ranks repeat a lot between positions, so they are parsed once and cached
+@functools.lru_cache(maxsize=1 << 16)
+def parse_fen_rank(rank):
+    masks, file, previous = {}, 0, ""
+    for symbol in rank:
+        if symbol in "12345678" and not previous.isdigit():  # Board.set_fen rejects two digits in a row
+            file += int(symbol)
+        elif symbol in SYMBOL_PLANES and file < 8:
+            plane = SYMBOL_PLANES[symbol]
+            masks[plane] = masks.get(plane, 0) | 1 << file
+            file += 1
+        else:
+            raise ValueError(f"Invalid rank in FEN: {rank!r}")
+        previous = symbol
+    if file != 8:
+        raise ValueError(f"Invalid rank in FEN: {rank!r}")
+    return tuple(masks.items())
+
+
+# Function to set up a board from a FEN (or the first four fields of an EPD line) several times faster
+# than Board.set_fen, by building the bitboards from cached ranks and setting them directly. FENs it does not
+# parse exactly like Board.set_fen go through Board.set_fen, which sets them up or rejects them: anything but
+# standard castling rights (Chess960 X-FEN and Shredder-FEN, repeated rights, rights without their corner
+# rook), promoted-piece markers, move counters that are not plain numbers and missing or extra fields
+def set_board_from_fen(board, fen):
+    fields = fen.split()
+    if not 4 <= len(fields) <= 6 or not STANDARD_CASTLING_REGEX.match(fields[2]) or "~" in fields[0] \
+            or not all(counter.isdigit() for counter in fields[4:]):
+        board.set_fen(fen)
+        return board
+    ranks = fields[0].split("/")
+    if len(ranks) != 8 or fields[1] not in ("w", "b"):
+        raise ValueError(f"Invalid FEN: {fen!r}")
+
+    planes = [0] * NUM_PLANES
+    for rank_index, rank in enumerate(ranks):
+        shift = (7 - rank_index) * 8  # The first rank of a FEN is rank 8
+        for plane, mask in parse_fen_rank(rank):
+            planes[plane] |= mask << shift
+
+    # Board.set_fen gives a right to the outermost rook on the back rank, which is the corner rook whenever
+    # there is one; rights without their corner rook are left to it
+    castling_rights = chess.BB_EMPTY
+    for right in fields[2].strip("-"):
+        castling_rights |= CASTLING_SQUARES[right]
+    if castling_rights & ~(planes[3] & chess.BB_RANK_1 | planes[9] & chess.BB_RANK_8):
+        board.set_fen(fen)
+        return board
+
+    board.clear_stack()
+    board.pawns, board.knights, board.bishops, board.rooks, board.queens, board.kings = (
+        white | black for white, black in zip(planes[:6], planes[6:]))
+    board.occupied_co[chess.WHITE] = planes[0] | planes[1] | planes[2] | planes[3] | planes[4] | planes[5]
+    board.occupied_co[chess.BLACK] = planes[6] | planes[7] | planes[8] | planes[9] | planes[10] | planes[11]
+    board.occupied = board.occupied_co[chess.WHITE] | board.occupied_co[chess.BLACK]
+    board.promoted = chess.BB_EMPTY
+    board.chess960 = False
+    board.turn = fields[1] == "w"
+    board.castling_rights = castling_rights
+    board.ep_square = None if fields[3] == "-" else chess.parse_square(fields[3])
+    board.halfmove_clock = int(fields[4]) if len(fields) > 4 else 0
+    board.fullmove_number = max(int(fields[5]), 1) if len(fields) > 5 else 1  # 0 means 1, as in set_fen
+    return board
+
+
+# Function to expand bitboards into the flattened 12x8x8 layout.
+# Stored big-endian, the first byte of a bitboard is rank 8 and its lowest bit is the a-file,
+# so unpacking with little bit order yields rows from rank 8 down to rank 1, files a to h
+def bitboards_to_tensor(bitboards):
+    masks = np.array(bitboards, dtype=">u8")
+    return np.unpackbits(masks.view(np.uint8), bitorder="little").astype(np.float32)
+
+
+# Function to convert the board state into a tensor (12x8x8), flattened to 768 features
+def board_to_tensor(board):
+    return bitboards_to_tensor(board_bitboards(board))
+
+
+# Function to encode a sequence of boards (or 12-tuples of bitboards) into the first rows of a
+# preallocated (N, 768) array of any dtype. Only per-batch scratch space is allocated
+def encode_boards_into(boards, out):
+    num_boards = len(boards)
+    if out.ndim != 2 or out.shape[1] != NUM_FEATURES or out.shape[0] < num_boards:
+        raise ValueError(f"Output buffer of shape {out.shape} cannot hold {num_boards} encoded positions")
+
+    masks = np.empty((num_boards, NUM_PLANES), dtype=">u8")
+    for i, board in enumerate(boards):
+        masks[i] = board if isinstance(board, tuple) else board_bitboards(board)
+    out[:num_boards] = np.unpackbits(masks.view(np.uint8), axis=1, bitorder="little")
+    return out[:num_boards]
+
+
+# Function to reuse an encoding buffer across batches, growing it only when a batch does not fit.
+# Packed buffers hold 96 uint8 bytes per row instead of 768 features
+def get_encode_buffer(buffer, num_rows, dtype=np.float32, packed=False):
+    width, dtype = (PACKED_BYTES, np.uint8) if packed else (NUM_FEATURES, dtype)
+    if buffer is None or buffer.shape[0] < num_rows or buffer.shape[1] != width or buffer.dtype != dtype:
+        buffer = np.empty((max(num_rows, 1), width), dtype=dtype)
+    return buffer
+
+
+# Function to pack dense (N, 768) 0/1 positions into (N, 96) uint8 rows
+def pack_positions(X):
+    return np.packbits(np.asarray(X) != 0, axis=1, bitorder="little")
+
+
+# Function to unpack (N, 96) packed rows to the dense (N, 768) layout, optionally into a preallocated buffer
+def unpack_positions(packed, out=None, dtype=np.float32):
+    bits = np.unpackbits(np.asarray(packed, dtype=np.uint8), axis=1, bitorder="little")
+    if out is None:
+        return bits.astype(dtype)
+    out[:len(bits)] = bits
+    return out[:len(bits)]
+
+
+# Function to encode an (N, 12) uint64 array of bitboards into a preallocated buffer, which may be
+# dense (N, 768) of any dtype or packed (N, 96) uint8
+def encode_bitboards_into(masks, out):
+    num_rows = len(masks)
+    if out.shape[1] == PACKED_BYTES:
+        out[:num_rows].view(">u8")[:] = masks
+    else:
+        out[:num_rows] = np.unpackbits(masks.astype(">u8").view(np.uint8), axis=1, bitorder="little")
+    return out[:num_rows]
+
+
+# Plane order of a color-flipped position: the white pieces become the black pieces and vice versa
+FLIP_PLANES = np.r_[NUM_PLANES // 2:NUM_PLANES, 0:NUM_PLANES // 2]
+
+
+# Function to mirror positions vertically and swap their colors (the position as seen by the other side).
+# Works on whole batches of dense (N, 768) or bit-packed (N, 96) rows: both hold 12 planes of 8 ranks,
+# 8 values or 1 byte per rank, so the flip is a plane swap plus a rank reversal on the (N, 12, 8, -1) view
+def flip_positions(X):
+    X = np.asarray(X)
+    view = X.reshape(len(X), NUM_PLANES, 8, -1)
+    return view[:, FLIP_PLANES, ::-1].reshape(X.shape)
@@ -1,163 +1,470 @@
 import chess.pgn
+import chess.polyglot
 import numpy as np
 import json
 import os
 import gc  # Garbage collector
+import argparse
+import multiprocessing
+import random
 
-# Function to parse a batch of games from a PGN file
-def parse_pgn_batch(pgn_file, start_game, batch_size):
-    games = []
-    with open(pgn_file) as pgn:
-        for i in range(start_game):
-            chess.pgn.read_game(pgn)  # Skip games until we reach the batch start point
+from board_encoding import NUM_PLANES, board_bitboards, encode_bitboards_into, get_encode_buffer
+from dataset_shards import append_shards, load_manifest
+from game_archive import GameBuffer, append_games, load_archive_manifest
+from move_vocab import (LEGAL_MASK_BYTES, NUM_MOVES, VOCAB_VERSION, backup_move_dict, in_vocabulary, legal_move_mask,
+                        move_to_index, require_fixed_vocabulary, vocabulary_dicts)
+from game_dedup import DUPLICATE, GameHashSet, extend_moves_hash, start_moves_hash
+from pgn_filters import BULLET_SECONDS, REJECTED, HeaderFilter, game_hash, game_split
+from pgn_index import load_pgn_index, seek_to_game
+from pgn_sources import ingested_games, is_compressed, open_pgn, source_fingerprint, source_key, source_record
 
-        for _ in range(batch_size):
-            game = chess.pgn.read_game(pgn)
-            if game is None:
-                break
-            board = game.board()
-            for move in game.mainline_moves():
-                games.append((board.copy(), move))
-                board.push(move)
-    return games
-
-# Function to convert the board state into a tensor (12x8x8)
-def board_to_tensor(board):
-    tensor = np.zeros((12, 8, 8), dtype=np.float32)
-    piece_map = {chess.PAWN: 0, chess.KNIGHT: 1, chess.BISHOP: 2, chess.ROOK: 3, chess.QUEEN: 4, chess.KING: 5}
-    for square in chess.SQUARES:
-        piece = board.piece_at(square)
-        if piece:
-            piece_type = piece_map[piece.piece_type]
-            color = 0 if piece.color == chess.WHITE else 1
-            tensor[color * 6 + piece_type][7 - chess.square_rank(square)][chess.square_file(square)] = 1
-    return tensor.flatten()
-
-# Helper function to one-hot encode y values
-def one_hot_encode(y, num_classes):
-    return np.eye(num_classes)[y]
-
-# Create move dictionaries (move to label and label to move)
-def create_move_dict(training_data, move_dict=None):
-    all_moves = set(move.uci() for _, move in training_data)
-    if move_dict is None:
-        move_list = sorted(list(all_moves))
-        move_dict = {move: idx for idx, move in enumerate(move_list)}
-        reverse_move_dict = {idx: move for move, idx in move_dict.items()}
-    else:
-        current_index = max(move_dict.values()) + 1
-        for move in all_moves:
-            if move not in move_dict:
-                move_dict[move] = current_index
-                current_index += 1
-        reverse_move_dict = {idx: move for move, idx in move_dict.items()}
-    return move_dict, reverse_move_dict
-
-# Save the move_dict and reverse_move_dict to JSON
+# Save the move_dict and reverse_move_dict of the fixed move vocabulary to JSON. A batch-grown
+# move_dict.json is backed up first, since the labels of older datasets can only be remapped with it
 def save_dicts(move_dict, reverse_move_dict, data_dir="data"):
     if not os.path.exists(data_dir):
         os.makedirs(data_dir)
+    backup_move_dict(f"{data_dir}/move_dict.json")
     with open(f"{data_dir}/move_dict.json", "w") as f:
         json.dump(move_dict, f)
     with open(f"{data_dir}/reverse_move_dict.json", "w") as f:
         json.dump(reverse_move_dict, f)
 
-# Function to pad arrays to the same size
-def pad_arrays(y_existing, y_new):
-    num_classes_existing = y_existing.shape[1]
-    num_classes_new = y_new.shape[1]
+# Append encoded positions and move labels to the sharded dataset in data_dir/dataset.
+# Only the new batch is written, as new shard files; labels are int16 indices into the fixed move vocabulary.
+# Extra per-position arrays (e.g. z, the Zobrist keys) are stored as additional shard files.
+# sources holds the ingestion records of the input files, saved in the same manifest update as the batch.
+# split holds the split code of every position; each split is written to its own shards
+def save_dataset(X, y, data_dir="data", sources=None, split=None, **extra_arrays):
+    arrays = {"X": X, "y": np.asarray(y, dtype=np.int16), **extra_arrays}
+    append_shards(f"{data_dir}/dataset", arrays, vocab_version=VOCAB_VERSION, num_classes=NUM_MOVES,
+                  sources=sources, splits=split)
 
-    # If existing data has fewer classes, pad it
-    if num_classes_existing < num_classes_new:
-        pad_width = num_classes_new - num_classes_existing
-        y_existing = np.pad(y_existing, ((0, 0), (0, pad_width)), 'constant')
-    
-    # If new data has fewer classes, pad it
-    elif num_classes_new < num_classes_existing:
-        pad_width = num_classes_existing - num_classes_new
-        y_new = np.pad(y_new, ((0, 0), (0, pad_width)), 'constant')
+# Append whole games, as move indices with their lengths, splits and starting FENs, to the game archive
+# in data_dir/games; positions are reconstructed from it later (see game_archive.py)
+def save_games(y, lengths, split, fens, data_dir="data", sources=None):
+    append_games(f"{data_dir}/games", {"y": y, "lengths": lengths, "split": split, "fens": fens}, sources=sources)
 
-    return y_existing, y_new
+# Buffer that positions are encoded into while the mainline of a game is walked. Only the 12 bitboards
+# and the move label of each position are kept, never a chess.Board, and the arrays are reused.
+# With zobrist=True the polyglot Zobrist key of every position is recorded as well.
+# With split_fractions=(val_fraction, test_fraction) every game is assigned to a split and the split
+# code of every position is recorded. With legal_masks=True the bit-packed mask of the legal moves of
+# every position is recorded (move generation roughly doubles the cost per position).
+# With skip_plies or positions_per_game set, games are subsampled: the first skip_plies plies are dropped
+# and at most positions_per_game of the rest are drawn uniformly, with a generator seeded by sample_seed
+# and the game's header hash so the same game always gives the same sample (see append_sampled)
+class PositionBuffer:
+    def __init__(self, capacity=1 << 16, packed=False, zobrist=False, split_fractions=None, legal_masks=False,
+                 skip_plies=0, positions_per_game=None, sample_seed=0):
+        self.packed = packed
+        self.bitboards = np.empty((capacity, NUM_PLANES), dtype=np.uint64)
+        self.labels = np.empty(capacity, dtype=np.int16)
+        self.keys = np.empty(capacity, dtype=np.uint64) if zobrist else None
+        self.split_fractions = split_fractions
+        self.splits = np.empty(capacity, dtype=np.uint8) if split_fractions else None
+        self.legal = np.empty((capacity, LEGAL_MASK_BYTES), dtype=np.uint8) if legal_masks else None
+        self.game_split = 0
+        self.skip_plies = skip_plies
+        self.positions_per_game = positions_per_game
+        self.sample_seed = sample_seed
+        self.sampling = skip_plies > 0 or positions_per_game is not None
+        self.game_rng = None
+        self.rows = 0
+        self.X_buffer = None
 
-# Prepare the dataset (appending new data)
-# Prepare the dataset (appending new data)
-def create_dataset(training_data, move_dict, data_dir="data"):
-    # Ensure the 'data' directory exists
-    if not os.path.exists(data_dir):
-        os.makedirs(data_dir)
+    # Called with the headers of every game before its positions are appended
+    def begin_game(self, headers):
+        if self.splits is not None:
+            self.game_split = game_split(headers, *self.split_fractions)
+        if self.sampling:
+            self.game_rng = random.Random(game_hash(headers) ^ self.sample_seed)
+
+    def append(self, board, move):
+        if self.rows == len(self.labels):
+            self.grow()
+        self.bitboards[self.rows] = board_bitboards(board)
+        self.labels[self.rows] = move_to_index(move)
+        if self.keys is not None:
+            self.keys[self.rows] = chess.polyglot.zobrist_hash(board)
+        if self.splits is not None:
+            self.splits[self.rows] = self.game_split
+        if self.legal is not None:
+            self.legal[self.rows] = legal_move_mask(board)
+        self.rows += 1
+
+    # Append the positions of a finished game (only the sampled ones when subsampling), given the board
+    # after its last move and the number of plies played. The board is walked back with board.pop(), so
+    # plies that are not sampled cost one push while parsing and one pop here, and are never encoded
+    def append_finished_game(self, board, num_plies):
+        plies = range(self.skip_plies, num_plies)
+        if self.positions_per_game is not None and len(plies) > self.positions_per_game:
+            plies = sorted(self.game_rng.sample(plies, self.positions_per_game))
+        if not plies:
+            return
+        sampled = set(plies)
+        first_row = self.rows
+        for ply in range(num_plies - 1, plies[0] - 1, -1):
+            move = board.pop()
+            if ply in sampled:
+                self.append(board, move)
+
+        # Put the game's positions back in move order
+        for array in (self.bitboards, self.labels, self.keys, self.splits, self.legal):
+            if array is not None:
+                array[first_row:self.rows] = array[first_row:self.rows][::-1].copy()
+
+    # Grow the arrays when a game does not fit; batches are only cut at game boundaries
+    def grow(self):
+        self.bitboards = np.concatenate((self.bitboards, np.empty_like(self.bitboards)))
+        self.labels = np.concatenate((self.labels, np.empty_like(self.labels)))
+        if self.keys is not None:
+            self.keys = np.concatenate((self.keys, np.empty_like(self.keys)))
+        if self.splits is not None:
+            self.splits = np.concatenate((self.splits, np.empty_like(self.splits)))
+        if self.legal is not None:
+            self.legal = np.concatenate((self.legal, np.empty_like(self.legal)))
+
+    # Encode the buffered positions into a reused output buffer (dense float32 or packed uint8).
+    # Returns the dataset arrays by shard name
+    def encoded(self):
+        self.X_buffer = get_encode_buffer(self.X_buffer, self.rows, packed=self.packed)
+        arrays = {"X": encode_bitboards_into(self.bitboards[:self.rows], self.X_buffer), "y": self.labels[:self.rows]}
+        if self.keys is not None:
+            arrays["z"] = self.keys[:self.rows]
+        if self.splits is not None:
+            arrays["split"] = self.splits[:self.rows]
+        if self.legal is not None:
+            arrays["legal"] = self.legal[:self.rows]
+        return arrays
+
+    def clear(self):
+        self.rows = 0
+
+# Function to create the buffer games are read into: a GameBuffer of move indices for the game archive,
+# otherwise a PositionBuffer of encoded positions
+def new_buffer(capacity=1 << 16, archive=False, **encode_options):
+    if archive:
+        return GameBuffer(capacity, encode_options.get("split_fractions"))
+    return PositionBuffer(capacity, **encode_options)
+
+# Function to walk the mainline of a game and append every position to a PositionBuffer
+def encode_game_into(game, buffer):
+    buffer.begin_game(game.headers)
+    board = game.board()
+    for move in game.mainline_moves():
+        if not buffer.sampling:
+            buffer.append(board, move)
+        board.push(move)
+    if buffer.sampling:
+        buffer.append_finished_game(board, len(board.move_stack))
+
+# Visitor that follows only the mainline while a game is read and appends every position straight to a
+# PositionBuffer. Unlike read_game's GameBuilder it builds no game tree: variations are skipped and
+# comments (such as Lichess %clk/%eval annotations) and NAGs are ignored.
+# Games rejected by header_filter are skipped without parsing their moves. When the buffer subsamples
+# games or seen_games (a GameHashSet) is given, moves are only counted and hashed while parsing, and the
+# positions are appended once the game is complete: games whose moves were seen before are dropped
+# without encoding anything
+class MainlineEncoder(chess.pgn.BaseVisitor):
+    def __init__(self, buffer, header_filter=None, seen_games=None):
+        self.buffer = buffer
+        self.header_filter = header_filter
+        self.seen_games = seen_games
+        self.deferred = buffer.sampling or seen_games is not None
+        self.headers = chess.pgn.Headers({})
+        self.rejected = False
+        self.duplicate = False
+        self.stopped = False
+        self.board = None
+        self.plies = 0
+        self.moves_hash = 0
+
+    def begin_headers(self):
+        return self.headers
+
+    def visit_header(self, tagname, tagvalue):
+        self.headers[tagname] = tagvalue
+
+    def end_headers(self):
+        if self.header_filter is not None and not self.header_filter(self.headers):
+            self.rejected = True
+            return chess.pgn.SKIP
+        if self.deferred:
+            self.moves_hash = start_moves_hash(self.headers.get("FEN", ""))
+        else:
+            self.buffer.begin_game(self.headers)
+        return None
 
-    X, y = [], []
-    num_classes = len(move_dict)  # Get total number of unique moves for one-hot encoding
+    def begin_variation(self):
+        return chess.pgn.SKIP
 
-    for board, move in training_data:
-        X.append(board_to_tensor(board))
-        y.append(move_dict[move.uci()])
+    def visit_move(self, board, move):
+        if self.stopped:
+            return
+        if not in_vocabulary(move):
+            # Handled like a parse error: the positions before the move are kept and the rest of the game
+            # is ignored. The parser's board moves on, so deferred games keep a copy of the board here
+            self.handle_error(ValueError(f"Move {move.uci()} is not in the move vocabulary"))
+            self.stopped = True
+            if self.deferred:
+                self.board = board.copy()
+            return
+        if self.deferred:
+            self.board = board  # The parser's board, which ends the game in its final position
+            self.plies += 1
+            if self.seen_games is not None:
+                self.moves_hash = extend_moves_hash(self.moves_hash, move)
+        else:
+            self.buffer.append(board, move)  # Called before the move is pushed
 
-    X = np.array(X)
-    y = np.array(y)
+    def end_game(self):
+        if not self.deferred or self.rejected:
+            return
+        if self.seen_games is not None and not self.seen_games.add(self.moves_hash):
+            self.duplicate = True
+            return
+        self.buffer.begin_game(self.headers)
+        if self.plies:
+            self.buffer.append_finished_game(self.board, self.plies)
 
-    # One-hot encode the new y data
-    y = one_hot_encode(y, num_classes)
+    # Like GameBuilder, log the error and keep the positions before it; the rest of the game is skipped
+    def handle_error(self, error):
+        chess.pgn.LOGGER.error("%s while parsing %r", error, self.headers)
 
-    # Load existing data if it exists
-    if os.path.exists(f"{data_dir}/X.npy"):
-        print("Loading existing data...")
-        X_existing = np.load(f"{data_dir}/X.npy")
-        y_existing = np.load(f"{data_dir}/y.npy")
+    def result(self):
+        if self.rejected:
+            return REJECTED
+        return DUPLICATE if self.duplicate else self.headers
 
-        # Check if dimensions of the new data and old data are the same
-        if X_existing.shape[1] != X.shape[1]:
-            raise ValueError(f"Dimension mismatch between existing X and new X: {X_existing.shape[1]} vs {X.shape[1]}")
+# Function to read the next game and encode its mainline into a PositionBuffer. Returns the game's
+# headers, REJECTED for games the filter rejects, DUPLICATE for games already in seen_games and None
+# at the end of file
+def read_encoded_game(pgn, buffer, header_filter=None, seen_games=None):
+    return chess.pgn.read_game(pgn, Visitor=lambda: MainlineEncoder(buffer, header_filter, seen_games))
 
-        # Pad y_existing and y to the same number of classes before concatenating
-        y_existing, y = pad_arrays(y_existing, y)
+# Function to move an open PGN file past its first start_game games. Plain files seek through the
+# .pgnidx index; compressed files cannot seek, so their games are skipped without parsing the moves
+def skip_to_game(pgn, pgn_file, start_game):
+    if is_compressed(pgn_file):
+        for _ in range(start_game):
+            if not chess.pgn.skip_game(pgn):
+                break
+    elif start_game:
+        seek_to_game(pgn, load_pgn_index(pgn_file), start_game)
+
+# Generator that streams a PGN file and encodes positions on the fly. Yields (arrays, num_games) once at
+# least batch_positions positions are buffered, so peak memory is bounded by the batch size rather than
+# by the number of games. The arrays are views into reused buffers and are only valid until the next batch.
+# Games rejected by header_filter are skipped without parsing their moves (they still count towards
+# max_games and num_games), and so are games whose moves are already in seen_games, a GameHashSet.
+# Reading starts at game start_game and stops before game max_games. encode_options are passed on to PositionBuffer.
+# Compressed files (.gz, .bz2, .xz, .zst) are decompressed on the fly while they are parsed
+def iter_encoded_batches(pgn_file, batch_positions, max_games=None, header_filter=None, start_game=0,
+                         seen_games=None, **encode_options):
+    buffer = new_buffer(batch_positions, **encode_options)
+    games_read, games_in_batch = start_game, 0
+    with open_pgn(pgn_file) as pgn:
+        skip_to_game(pgn, pgn_file, start_game)
+        while max_games is None or games_read < max_games:
+            if read_encoded_game(pgn, buffer, header_filter, seen_games) is None:
+                break
+            games_read += 1
+            games_in_batch += 1
+
+            if buffer.rows >= batch_positions:
+                yield buffer.encoded(), games_in_batch
+                buffer.clear()
+                games_in_batch = 0
+
+    # Also yields a final batch without positions (all games rejected), so those games count as read
+    if games_in_batch:
+        yield buffer.encoded(), games_in_batch
+
+# Worker function: parse a range of games starting at a byte offset and encode every position.
+# With a dedup_dir, games already in its GameHashSet (memory-mapped from the snapshot written before the
+# batch was dispatched) or earlier in the range are dropped, and the
+# moves hash and number of rows of every kept game (game_keys, game_rows) and the number of dropped games
+# (duplicates) are returned as well
+def parse_and_encode_range(task):
+    pgn_file, offset, num_games, header_filter, dedup_dir, encode_options = task
+    buffer = new_buffer(**encode_options)
+    seen_games = GameHashSet(dedup_dir, snapshot=True) if dedup_dir is not None else None
+    game_rows = []
+    with open(pgn_file) as pgn:
+        pgn.seek(offset)
+        for _ in range(num_games):
+            rows = buffer.rows
+            game = read_encoded_game(pgn, buffer, header_filter, seen_games)
+            if game is None:
+                break
+            if game is not REJECTED and game is not DUPLICATE:
+                game_rows.append(buffer.rows - rows)
+    arrays = {name: array.copy() for name, array in buffer.encoded().items()}
+    if seen_games is not None:
+        arrays["game_keys"] = np.array(seen_games.unsaved, dtype=np.uint64)
+        arrays["game_rows"] = np.array(game_rows, dtype=np.int64)
+        arrays["duplicates"] = np.array([seen_games.duplicates])
+    return arrays
 
-        # Concatenate the old and new data
-        X = np.concatenate((X_existing, X), axis=0)
-        y = np.concatenate((y_existing, y), axis=0)
+# Function to split a batch of games into byte ranges aligned to game boundaries
+def split_game_ranges(pgn_file, offsets, start_game, end_game, num_ranges, header_filter, dedup_dir, encode_options):
+    num_games = end_game - start_game
+    chunk_size = -(-num_games // num_ranges)  # Ceiling division
+    return [(pgn_file, int(offsets[first]), min(chunk_size, end_game - first), header_filter, dedup_dir, encode_options)
+            for first in range(start_game, end_game, chunk_size)]
 
-    # Save the updated dataset
-    np.save(f"{data_dir}/X.npy", X)
-    np.save(f"{data_dir}/y.npy", y)
+# Function to keep only some games of a batch, given a boolean per game and the number of rows of every game.
+# Archive batches hold one entry per game in every array but y; position batches hold one row per position
+def select_games(arrays, keep, game_rows):
+    rows = np.repeat(keep, game_rows)
+    per_game = ("lengths", "split", "fens") if "lengths" in arrays else ()
+    return {name: array[keep if name in per_game else rows] for name, array in arrays.items()}
 
+# Generator that parses and encodes batches of games in parallel worker processes, yielding (arrays, num_games).
+# Results are merged in file order, so the output matches a single-process run. With seen_games, workers
+# drop games already in it; repeats between the ranges of a batch are dropped here, in file order
+def iter_encoded_batches_parallel(pgn_file, batch_size, max_games, pool, workers, header_filter=None, start_game=0,
+                                  seen_games=None, **encode_options):
+    offsets = load_pgn_index(pgn_file)
+    end = len(offsets) if max_games is None else min(max_games, len(offsets))
+    for first in range(start_game, end, batch_size):
+        last = min(first + batch_size, end)
+        dedup_dir = None
+        if seen_games is not None:
+            seen_games.write_snapshot()
+            dedup_dir = seen_games.directory
+        ranges = split_game_ranges(pgn_file, offsets, first, last, workers, header_filter, dedup_dir, encode_options)
+        results = pool.map(parse_and_encode_range, ranges)
+        arrays = {name: np.concatenate([part[name] for part in results], axis=0) for name in results[0]}
+        if seen_games is not None:
+            keep = np.array([seen_games.add(int(key)) for key in arrays.pop("game_keys")], dtype=bool)
+            game_rows = arrays.pop("game_rows")
+            seen_games.duplicates += int(arrays.pop("duplicates").sum())
+            if not keep.all():
+                arrays = select_games(arrays, keep, game_rows)
+        yield arrays, last - first
 
-# Main process to parse PGN, create dictionaries, and generate dataset in batches
+
+# Main process to parse PGN and generate the dataset in batches
 if __name__ == "__main__":
     # Path to your existing PGN file and your Google Drive PGN file
-    pgn_files = [
+    default_pgn_files = [
         "/content/chess_engine/scripts/lichess_data.pgn",  # Example existing data
         "/content/drive/MyDrive/Chess_png/lichess_db_standard_rated_2016-08.pgn"  # Your file from Google Drive
     ]
 
-    batch_size = 1000  # Number of games to process per batch
-    total_games = 5000  # Total games to process per PGN file
+    parser = argparse.ArgumentParser(description="Preprocess PGN games into training data.")
+    parser.add_argument("pgn_files", nargs="*", default=default_pgn_files,
+                        help="PGN files to process (.pgn, or compressed .pgn.gz/.bz2/.xz/.zst)")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Number of games to process per batch in --workers mode")
+    parser.add_argument("--total-games", type=int, default=5000,
+                        help="Total games to ingest per PGN file, counting earlier runs (0 for all games)")
+    parser.add_argument("--batch-positions", type=int, default=1 << 16,
+                        help="Number of positions encoded per batch in single-process mode")
+    parser.add_argument("--packed", action="store_true", help="Store positions bit-packed (96 bytes each)")
+    parser.add_argument("--zobrist", action="store_true",
+                        help="Also store the Zobrist key of every position (needed by dedup_positions.py)")
+    parser.add_argument("--legal-masks", action="store_true",
+                        help="Also store a bit-packed mask of the legal moves of every position (246 bytes each)")
+    parser.add_argument("--archive", action="store_true",
+                        help="Store games as move sequences in data/games (about 2 bytes per position) instead of encoded positions")
+    parser.add_argument("--skip-plies", type=int, default=0, help="Drop the first plies of every game (opening book moves)")
+    parser.add_argument("--positions-per-game", type=int, default=None,
+                        help="Keep at most this many positions per game, drawn uniformly after --skip-plies")
+    parser.add_argument("--sample-seed", type=int, default=0,
+                        help="Seed of the per-game position sampling (the same seed gives the same sample)")
+    parser.add_argument("--dedup-games", action="store_true",
+                        help="Drop games whose mainline moves repeat a game already ingested, in this or an earlier run")
+    parser.add_argument("--min-rating", type=int, default=None, help="Skip games where either player is rated below this")
+    parser.add_argument("--min-time-control", type=int, default=None,
+                        help="Skip games whose estimated duration (base + 40 x increment) is below this many seconds")
+    parser.add_argument("--exclude-bullet", action="store_true",
+                        help=f"Skip bullet games (same as --min-time-control {BULLET_SECONDS})")
+    parser.add_argument("--results", default=None, help="Comma-separated results to keep, e.g. 1-0,0-1")
+    parser.add_argument("--val-fraction", type=float, default=0.05, help="Fraction of games assigned to the validation split")
+    parser.add_argument("--test-fraction", type=float, default=0.05, help="Fraction of games assigned to the test split")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for parsing and encoding")
+    args = parser.parse_args()
+    if args.archive and (args.packed or args.zobrist or args.legal_masks):
+        parser.error("--packed, --zobrist and --legal-masks apply to encoded positions, not to --archive")
+    if args.archive and (args.skip_plies or args.positions_per_game is not None):
+        parser.error("--skip-plies and --positions-per-game apply to encoded positions, not to --archive")
+
+    pgn_files = args.pgn_files
+    batch_size = args.batch_size  # Number of games to process per batch
+    total_games = args.total_games or None  # Total games to ingest per PGN file
+
+    # Datasets built with the old batch-grown move_dict.json must be remapped before appending to them
+    require_fixed_vocabulary()
+
+    # Games are assigned to train/val/test splits by a hash of their headers; keep the fractions
+    # unchanged when adding to a dataset, so every game stays in its split
+    split_fractions = (args.val_fraction, args.test_fraction)
+    encode_options = {"packed": args.packed, "zobrist": args.zobrist, "split_fractions": split_fractions,
+                      "legal_masks": args.legal_masks, "archive": args.archive, "skip_plies": args.skip_plies,
+                      "positions_per_game": args.positions_per_game, "sample_seed": args.sample_seed}
+
+    # Encoded positions go to the sharded dataset in data/dataset, whole games to the game archive in data/games
+    save_batch = save_games if args.archive else save_dataset
 
-    # Load existing move_dict if it exists
-    move_dict_path = "data/move_dict.json"
-    if os.path.exists(move_dict_path):
-        with open(move_dict_path, 'r') as f:
-            move_dict = json.load(f)
-    else:
-        move_dict = None
+    # Games are filtered on their headers before any of their moves are parsed
+    header_filter = None
+    min_time_control = BULLET_SECONDS if args.exclude_bullet and args.min_time_control is None else args.min_time_control
+    if args.min_rating is not None or min_time_control is not None or args.results:
+        header_filter = HeaderFilter(args.min_rating, min_time_control, args.results.split(",") if args.results else None)
+
+    # The moves hashes of ingested games are kept next to the dataset (or archive), so repeats are also
+    # found across files and runs
+    seen_games = GameHashSet("data/games" if args.archive else "data/dataset") if args.dedup_games else None
+
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
 
     for pgn_file in pgn_files:
-        print(f"Processing file: {pgn_file}")
+        # Games already in the dataset (from an earlier or interrupted run) are not processed again
+        sources = load_archive_manifest("data/games")["sources"] if args.archive else load_manifest("data/dataset")["sources"]
+        start_game = ingested_games(sources, pgn_file)
+        fingerprint = source_fingerprint(pgn_file)
+        if start_game is None:
+            print(f"Skipping {pgn_file}: it changed since it was ingested (not only by appending games)")
+        elif total_games is not None and start_game >= total_games:
+            print(f"Skipping {pgn_file}: its first {start_game} games are already ingested")
+        elif pool is not None and not is_compressed(pgn_file):
+            print(f"Processing file: {pgn_file} from game {start_game}")
+            for arrays, num_games in iter_encoded_batches_parallel(pgn_file, batch_size, total_games, pool, args.workers,
+                                                                   header_filter, start_game, seen_games, **encode_options):
+                print(f"Processed games {start_game} to {start_game + num_games} with {args.workers} workers...")
+                start_game += num_games
+
+                save_batch(**arrays, sources={source_key(pgn_file): source_record(fingerprint, start_game)})
+                if seen_games is not None:
+                    seen_games.save()  # Only once the batch is saved, so no game is marked seen without being kept
+
+                del arrays
+                gc.collect()
+        else:
+            # Compressed files cannot be indexed or seeked, so they are always streamed in this process
+            if pool is not None:
+                print(f"{pgn_file} is compressed, streaming it in a single process")
 
-        for start_game in range(0, total_games, batch_size):
-            print(f"Processing games {start_game} to {start_game + batch_size}...")
-            training_data_batch = parse_pgn_batch(pgn_file, start_game, batch_size)
+            # Positions are encoded while the games are parsed, so no Board copies are kept around
+            print(f"Processing file: {pgn_file} from game {start_game}")
+            for arrays, num_games in iter_encoded_batches(pgn_file, args.batch_positions, total_games,
+                                                          header_filter, start_game, seen_games, **encode_options):
+                print(f"Processed games {start_game} to {start_game + num_games} ({len(arrays['y'])} positions)...")
+                start_game += num_games
 
-            # Create or update move dictionaries with the batch data
-            move_dict, reverse_move_dict = create_move_dict(training_data_batch, move_dict)
+                save_batch(**arrays, sources={source_key(pgn_file): source_record(fingerprint, start_game)})
+                if seen_games is not None:
+                    seen_games.save()  # Only once the batch is saved, so no game is marked seen without being kept
 
-            # Create and save the dataset for this batch
-            create_dataset(training_data_batch, move_dict)
+    if pool is not None:
+        pool.close()
+        pool.join()
 
-            # Free up memory after processing the batch
-            del training_data_batch
-            gc.collect()
+    if seen_games is not None:
+        print(f"Dropped {seen_games.duplicates} duplicate games ({len(seen_games)} distinct games ingested)")
 
-    # Save the updated move dictionaries
-    save_dicts(move_dict, reverse_move_dict)
+    # Save the move dictionaries of the fixed vocabulary
+    save_dicts(*vocabulary_dicts())
     
     print("Data preprocessing complete. Files saved in the 'data/' folder.")
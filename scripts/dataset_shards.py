@@ -0,0 +1,254 @@
+import json
+import os
+import zlib
+
+import numpy as np
+
+from board_encoding import PACKED_BYTES
+
+MANIFEST_NAME = "manifest.json"
+MANIFEST_VERSION = 1
+DEFAULT_SHARD_ROWS = 1 << 16  # Maximum number of positions per shard file
+SPLITS = ("train", "val", "test")  # Shards belong to one split; split codes index this tuple
+
+
+# Function to create the manifest of an empty dataset. "sources" records how far each input file
+# has been ingested, so interrupted or repeated preprocessing runs can resume
+def new_manifest():
+    return {"version": MANIFEST_VERSION, "x_format": None, "vocab_version": None, "num_classes": 0,
+            "total_rows": 0, "shards": [], "sources": {}}
+
+
+# Function to load the manifest of a sharded dataset (an empty manifest if the dataset does not exist yet)
+def load_manifest(dataset_dir):
+    manifest_path = os.path.join(dataset_dir, MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return new_manifest()
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != MANIFEST_VERSION:
+        raise ValueError(f"Unsupported dataset manifest version in {manifest_path}: {manifest.get('version')}")
+    manifest.setdefault("sources", {})  # Datasets written before ingestion was tracked
+    return manifest
+
+
+# Function to save the manifest atomically, so readers never see a half-written file
+def save_manifest(dataset_dir, manifest):
+    manifest_path = os.path.join(dataset_dir, MANIFEST_NAME)
+    tmp_path = manifest_path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(manifest, f, indent=1)
+    os.replace(tmp_path, manifest_path)
+
+
+# Function to compute the CRC32 checksum of a file, reading it in chunks
+def file_checksum(path, chunk_size=1 << 20):
+    checksum = 0
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            checksum = zlib.crc32(chunk, checksum)
+    return f"{checksum:08x}"
+
+
+# Function to get the path of one array of a shard
+def shard_path(dataset_dir, shard, name):
+    return os.path.join(dataset_dir, shard["files"][name]["name"])
+
+
+# Function to write the arrays of one shard as new files and return its manifest entry
+def write_shard(dataset_dir, index, split, arrays):
+    shard = {"index": index, "split": split, "rows": len(arrays["X"]), "files": {}}
+    for name, array in arrays.items():
+        file_name = f"{name}_{index:05d}.npy"
+        path = os.path.join(dataset_dir, file_name)
+        np.save(path, array)
+        shard["files"][name] = {"name": file_name, "crc32": file_checksum(path)}
+    return shard
+
+
+# Function to append arrays with matching row counts (at least "X" and "y") to a sharded dataset.
+# Rows first fill the last shard of their split up to shard_rows, so appending many small batches does not
+# leave many small shards: that shard (fewer than shard_rows rows) is read and written again under a new
+# file number, and its old files are removed once the manifest lists the new ones. Other shards are never
+# read or rewritten, and shard numbers only grow, so files of committed shards are never overwritten.
+# sources maps input files to their updated ingestion records, saved together with the new shards.
+# splits holds the split code of every row; the rows of each split are written to their own shards
+# (all rows are training rows without it)
+def append_shards(dataset_dir, arrays, vocab_version, num_classes, shard_rows=DEFAULT_SHARD_ROWS, sources=None,
+                  splits=None):
+    num_rows = len(arrays["X"])
+    if any(len(array) != num_rows for array in arrays.values()):
+        raise ValueError("All arrays appended to a shard must have the same number of rows")
+
+    os.makedirs(dataset_dir, exist_ok=True)
+    manifest = load_manifest(dataset_dir)
+
+    # All shards of a dataset share the position format and the move vocabulary
+    x_format = "packed" if arrays["X"].shape[1] == PACKED_BYTES else "dense"
+    if manifest["shards"] and manifest["x_format"] != x_format:
+        raise ValueError(f"Cannot append {x_format} positions to a dataset of {manifest['x_format']} positions")
+    if manifest["shards"] and manifest["vocab_version"] != vocab_version:
+        raise ValueError(f"Cannot append labels of vocabulary {vocab_version} to a dataset using "
+                         f"vocabulary {manifest['vocab_version']}")
+    if manifest["shards"] and set(manifest["shards"][-1]["files"]) != set(arrays):
+        raise ValueError(f"Cannot append arrays {sorted(arrays)} to a dataset storing "
+                         f"{sorted(manifest['shards'][-1]['files'])}")
+    manifest["x_format"] = x_format
+    manifest["vocab_version"] = vocab_version
+    manifest["num_classes"] = max(manifest["num_classes"], num_classes)
+
+    if splits is None:
+        parts = [("train", arrays)]
+    else:
+        splits = np.asarray(splits)
+        parts = [(split, {name: array[splits == code] for name, array in arrays.items()})
+                 for code, split in enumerate(SPLITS)]
+
+    next_index = max((shard["index"] for shard in manifest["shards"]), default=-1) + 1
+    replaced = []
+    for split, part in parts:
+        part_rows = len(part["X"])
+        if part_rows == 0:
+            continue
+
+        # Top up the last shard of the split; it keeps its place, so the rows of the split stay in order
+        last = next((position for position in range(len(manifest["shards"]) - 1, -1, -1)
+                     if shard_split(manifest["shards"][position]) == split), None)
+        if last is not None and manifest["shards"][last]["rows"] < shard_rows:
+            old_shard = manifest["shards"][last]
+            fill = min(shard_rows - old_shard["rows"], part_rows)
+            merged = {name: np.concatenate((np.load(shard_path(dataset_dir, old_shard, name)), array[:fill]))
+                      for name, array in part.items()}
+            manifest["shards"][last] = write_shard(dataset_dir, next_index, split, merged)
+            manifest["total_rows"] += fill
+            replaced.append(old_shard)
+            next_index += 1
+            part = {name: array[fill:] for name, array in part.items()}
+            part_rows -= fill
+
+        for start in range(0, part_rows, shard_rows):
+            shard = write_shard(dataset_dir, next_index, split,
+                                {name: array[start:start + shard_rows] for name, array in part.items()})
+            manifest["shards"].append(shard)
+            manifest["total_rows"] += shard["rows"]
+            next_index += 1
+
+    # The manifest is saved once all shards are written, so the shards of a call and the ingestion records
+    # are committed together. A crash leaves unlisted shard files that the next append overwrites, or, right
+    # after the manifest is saved, the unlisted old files of a topped-up shard
+    manifest["sources"].update(sources or {})
+    save_manifest(dataset_dir, manifest)
+    for old_shard in replaced:
+        for name in old_shard["files"]:
+            os.remove(shard_path(dataset_dir, old_shard, name))
+    return manifest
+
+
+# Function to get the split of a shard; shards written before splits existed are training shards
+def shard_split(shard):
+    return shard.get("split", "train")
+
+
+# Generator that yields the arrays of each shard in order, memory-mapped by default.
+# With split set, only the shards of that split are read
+def iter_shards(dataset_dir, names=("X", "y"), mmap_mode="r", split=None):
+    manifest = load_manifest(dataset_dir)
+    for shard in manifest["shards"]:
+        if split is not None and shard_split(shard) != split:
+            continue
+        yield tuple(np.load(shard_path(dataset_dir, shard, name), mmap_mode=mmap_mode) for name in names)
+
+
+# Read-only view of several arrays (e.g. memory-mapped shards) as one array concatenated along
+# the first axis. Indexing with an integer, a slice or an integer array only reads the rows asked for
+class ShardedArray:
+    def __init__(self, parts):
+        self.parts = list(parts)
+        if not self.parts:
+            raise ValueError("ShardedArray needs at least one part")
+        self.bounds = np.cumsum([0] + [len(part) for part in self.parts])
+        self.shape = (int(self.bounds[-1]),) + self.parts[0].shape[1:]
+        self.dtype = self.parts[0].dtype
+        self.ndim = len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            row = key + len(self) if key < 0 else key
+            if not 0 <= row < len(self):
+                raise IndexError(f"Index {key} out of range for {len(self)} rows")
+            part = int(np.searchsorted(self.bounds, row, side="right")) - 1
+            return self.parts[part][row - self.bounds[part]]
+
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if step != 1:
+                return self[np.arange(start, stop, step)]
+            pieces = []
+            for part, (lo, hi) in enumerate(zip(self.bounds[:-1], self.bounds[1:])):
+                if lo < stop and start < hi:
+                    pieces.append(self.parts[part][max(start, lo) - lo:min(stop, hi) - lo])
+            if not pieces:
+                return np.empty((0,) + self.shape[1:], dtype=self.dtype)
+            return np.concatenate(pieces, axis=0)
+
+        rows = np.asarray(key)
+        if rows.dtype == bool:
+            rows = np.flatnonzero(rows)
+        rows = np.where(rows < 0, rows + len(self), rows)
+        if rows.size and (rows.min() < 0 or rows.max() >= len(self)):
+            raise IndexError(f"Row index out of range for {len(self)} rows")
+        parts_of_rows = np.searchsorted(self.bounds, rows, side="right") - 1
+        result = np.empty(rows.shape + self.shape[1:], dtype=self.dtype)
+        for part in np.unique(parts_of_rows):
+            selected = parts_of_rows == part
+            result[selected] = self.parts[part][rows[selected] - self.bounds[part]]
+        return result
+
+    def __array__(self, dtype=None, copy=None):
+        array = self[:]
+        return array if dtype is None else array.astype(dtype)
+
+
+# Function to open a sharded dataset as virtual arrays over memory-mapped shards.
+# Nothing is read up front; the OS page cache buffers the shards as they are accessed
+def open_dataset(dataset_dir, names=("X", "y"), split=None):
+    parts = list(zip(*iter_shards(dataset_dir, names, mmap_mode="r", split=split)))
+    if not parts:
+        raise FileNotFoundError(f"No {split + ' ' if split else ''}shards found in {dataset_dir}")
+    return tuple(ShardedArray(arrays) for arrays in parts)
+
+
+# Function to check every shard file against the row counts and checksums in the manifest
+def verify_dataset(dataset_dir):
+    manifest = load_manifest(dataset_dir)
+    problems = []
+    for shard in manifest["shards"]:
+        for name, entry in shard["files"].items():
+            path = shard_path(dataset_dir, shard, name)
+            if not os.path.exists(path):
+                problems.append(f"{entry['name']}: missing")
+            elif file_checksum(path) != entry["crc32"]:
+                problems.append(f"{entry['name']}: checksum mismatch")
+            elif len(np.load(path, mmap_mode="r")) != shard["rows"]:
+                problems.append(f"{entry['name']}: expected {shard['rows']} rows")
+    return problems
+
+
+if __name__ == "__main__":
+    import sys
+
+    for dataset_dir in sys.argv[1:]:
+        manifest = load_manifest(dataset_dir)
+        problems = verify_dataset(dataset_dir)
+        print(f"{dataset_dir}: {len(manifest['shards'])} shards, {manifest['total_rows']} rows, "
+              f"{manifest['x_format']} positions, {manifest['num_classes']} classes")
+        for split in SPLITS:
+            split_rows = sum(shard["rows"] for shard in manifest["shards"] if shard_split(shard) == split)
+            print(f"  {split}: {split_rows} rows")
+        for problem in problems:
+            print(f"  {problem}")
+        if not problems:
+            print("  all shards verified")
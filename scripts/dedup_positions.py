@@ -0,0 +1,174 @@
+import argparse
+import os
+import shutil
+import tempfile
+
+import numpy as np
+
+from board_encoding import PACKED_BYTES, pack_positions
+from dataset_shards import DEFAULT_SHARD_ROWS, SPLITS, append_shards, iter_shards, load_manifest, shard_split
+
+DEFAULT_RUN_ROWS = 1 << 20  # Positions sorted in memory per on-disk run (about 100 MB)
+DEFAULT_MERGE_ROWS = 1 << 16  # Positions read from each run per merge step
+DEFAULT_TOP_MOVES = 16  # Distinct moves kept per unique position
+
+# One record per input position, as stored in the sorted runs
+RECORD_DTYPE = np.dtype([("key", "<u8"), ("label", "<i2"), ("position", "u1", (PACKED_BYTES,))])
+
+
+# Function to split the shards of one split of a dataset into runs of records sorted by Zobrist key,
+# written to run_dir
+def write_sorted_runs(dataset_dir, run_dir, run_rows=DEFAULT_RUN_ROWS, split="train"):
+    manifest = load_manifest(dataset_dir)
+    if not manifest["shards"] or "z" not in manifest["shards"][0]["files"]:
+        raise ValueError(f"{dataset_dir} has no Zobrist keys; rebuild it with data_preprocessing.py --zobrist")
+
+    run_paths, pending, pending_rows = [], [], 0
+
+    def flush():
+        records = np.concatenate(pending)
+        records = records[np.argsort(records["key"], kind="stable")]
+        path = os.path.join(run_dir, f"{split}_run_{len(run_paths):05d}.npy")
+        np.save(path, records)
+        run_paths.append(path)
+
+    for X, y, z in iter_shards(dataset_dir, names=("X", "y", "z"), split=split):
+        records = np.empty(len(y), dtype=RECORD_DTYPE)
+        records["key"] = z
+        records["label"] = y
+        records["position"] = X if X.shape[1] == PACKED_BYTES else pack_positions(X)
+        pending.append(records)
+        pending_rows += len(records)
+        if pending_rows >= run_rows:
+            flush()
+            pending, pending_rows = [], 0
+    if pending:
+        flush()
+    return run_paths
+
+
+# Generator that merges sorted runs into key-ordered chunks without loading any run completely.
+# Each step takes every buffered record up to the smallest last key among runs that still have unread
+# records, which is safe because no unread record can sort before it
+def merge_sorted_runs(run_paths, merge_rows=DEFAULT_MERGE_ROWS):
+    runs = [np.load(path, mmap_mode="r") for path in run_paths]
+    read = [min(merge_rows, len(run)) for run in runs]
+    chunks = [np.array(run[:n]) for run, n in zip(runs, read)]
+
+    while any(len(chunk) for chunk in chunks):
+        unfinished = [chunk["key"][-1] for chunk, run, n in zip(chunks, runs, read) if n < len(run) and len(chunk)]
+        bound = min(unfinished) if unfinished else np.iinfo(np.uint64).max
+
+        taken = []
+        for i, chunk in enumerate(chunks):
+            cut = np.searchsorted(chunk["key"], bound, side="right")
+            taken.append(chunk[:cut])
+            chunks[i] = chunk[cut:]
+            if not len(chunks[i]) and read[i] < len(runs[i]):
+                chunks[i] = np.array(runs[i][read[i]:read[i] + merge_rows])
+                read[i] += len(chunks[i])
+
+        merged = np.concatenate(taken)
+        yield merged[np.argsort(merged["key"], kind="stable")]
+
+
+# Function to fold a key-sorted chunk of records into unique positions with per-move counts.
+# Returns the arrays of the deduplicated rows: X, y (most frequent move), z, count, move_labels, move_counts
+def aggregate_records(records, top_moves=DEFAULT_TOP_MOVES):
+    # Count every (key, label) pair; records are sorted by key, so a stable sort by label groups the pairs
+    order = np.lexsort((records["label"], records["key"]))
+    keys, labels = records["key"][order], records["label"][order]
+    pair_start = np.flatnonzero(np.r_[True, (keys[1:] != keys[:-1]) | (labels[1:] != labels[:-1])])
+    pair_keys, pair_labels = keys[pair_start], labels[pair_start]
+    pair_counts = np.diff(np.r_[pair_start, len(keys)]).astype(np.uint32)
+
+    # Group the pairs by key, most frequent move first
+    group_start = np.flatnonzero(np.r_[True, pair_keys[1:] != pair_keys[:-1]])
+    group_of_pair = np.repeat(np.arange(len(group_start)), np.diff(np.r_[group_start, len(pair_keys)]))
+    by_count = np.lexsort((pair_labels, -pair_counts.astype(np.int64), group_of_pair))
+    pair_keys, pair_labels, pair_counts = pair_keys[by_count], pair_labels[by_count], pair_counts[by_count]
+    rank = np.arange(len(pair_keys)) - group_start[group_of_pair]
+
+    num_rows = len(group_start)
+    move_labels = np.full((num_rows, top_moves), -1, dtype=np.int16)
+    move_counts = np.zeros((num_rows, top_moves), dtype=np.uint32)
+    kept = rank < top_moves
+    move_labels[group_of_pair[kept], rank[kept]] = pair_labels[kept]
+    move_counts[group_of_pair[kept], rank[kept]] = pair_counts[kept]
+
+    first_record = np.flatnonzero(np.r_[True, records["key"][1:] != records["key"][:-1]])
+    return {
+        "X": records["position"][first_record],
+        "y": pair_labels[group_start],
+        "z": pair_keys[group_start],
+        "count": np.add.reduceat(pair_counts, group_start).astype(np.uint32),
+        "move_labels": move_labels,
+        "move_counts": move_counts,
+    }
+
+
+# Function to deduplicate a sharded dataset by Zobrist key into a new sharded dataset whose rows carry
+# move counts (usable as soft targets). Works out of core: memory is bounded by run_rows and merge_rows.
+# Each split is deduplicated on its own, so no position moves between train, val and test
+def dedup_dataset(dataset_dir, output_dir, run_rows=DEFAULT_RUN_ROWS, merge_rows=DEFAULT_MERGE_ROWS,
+                  top_moves=DEFAULT_TOP_MOVES, shard_rows=DEFAULT_SHARD_ROWS, tmp_dir=None):
+    manifest = load_manifest(dataset_dir)
+    if load_manifest(output_dir)["shards"]:
+        raise ValueError(f"{output_dir} already contains a dataset")
+
+    run_dir = tempfile.mkdtemp(prefix="dedup_runs_", dir=tmp_dir)
+    try:
+        for split in SPLITS:
+            if any(shard_split(shard) == split for shard in manifest["shards"]):
+                dedup_split(dataset_dir, output_dir, run_dir, manifest, split, run_rows, merge_rows, top_moves, shard_rows)
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+    output_manifest = load_manifest(output_dir)
+    return manifest["total_rows"], output_manifest["total_rows"]
+
+
+# Function to deduplicate the shards of one split and append the result to the output dataset
+def dedup_split(dataset_dir, output_dir, run_dir, manifest, split, run_rows, merge_rows, top_moves, shard_rows):
+    run_paths = write_sorted_runs(dataset_dir, run_dir, run_rows, split)
+
+    # The last key of every merged chunk may continue in the next one, so it is held back
+    pending = np.empty(0, dtype=RECORD_DTYPE)
+    output_buffer, output_rows = [], 0
+    for chunk in merge_sorted_runs(run_paths, merge_rows):
+        records = np.concatenate((pending, chunk))
+        cut = np.searchsorted(records["key"], records["key"][-1], side="left")
+        pending = records[cut:]
+        if cut:
+            output_buffer.append(aggregate_records(records[:cut], top_moves))
+            output_rows += len(output_buffer[-1]["y"])
+        if output_rows >= shard_rows:
+            write_output(output_dir, output_buffer, manifest, shard_rows, split)
+            output_buffer, output_rows = [], 0
+    if len(pending):
+        output_buffer.append(aggregate_records(pending, top_moves))
+    if output_buffer:
+        write_output(output_dir, output_buffer, manifest, shard_rows, split)
+
+
+# Function to append aggregated rows of one split to the output dataset
+def write_output(output_dir, output_buffer, manifest, shard_rows, split):
+    arrays = {name: np.concatenate([part[name] for part in output_buffer]) for name in output_buffer[0]}
+    append_shards(output_dir, arrays, vocab_version=manifest["vocab_version"], num_classes=manifest["num_classes"],
+                  shard_rows=shard_rows, splits=np.full(len(arrays["y"]), SPLITS.index(split), dtype=np.uint8))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Deduplicate dataset positions by Zobrist key, aggregating move counts.")
+    parser.add_argument("dataset_dir", nargs="?", default="data/dataset", help="Input dataset (built with --zobrist)")
+    parser.add_argument("output_dir", nargs="?", default="data/dataset_dedup", help="Output dataset directory")
+    parser.add_argument("--run-rows", type=int, default=DEFAULT_RUN_ROWS, help="Positions per sorted on-disk run")
+    parser.add_argument("--top-moves", type=int, default=DEFAULT_TOP_MOVES, help="Distinct moves kept per position")
+    parser.add_argument("--tmp-dir", default=None, help="Directory for the temporary sorted runs")
+    args = parser.parse_args()
+
+    input_rows, output_rows = dedup_dataset(args.dataset_dir, args.output_dir, run_rows=args.run_rows,
+                                            top_moves=args.top_moves, tmp_dir=args.tmp_dir)
+    ratio = input_rows / output_rows if output_rows else float("nan")
+    print(f"Deduplicated {input_rows} positions into {output_rows} unique positions "
+          f"({ratio:.2f}x, {100 * (1 - output_rows / max(input_rows, 1)):.1f}% removed)")
@@ -0,0 +1,199 @@
+import argparse
+import json
+import multiprocessing
+import os
+
+import chess
+import numpy as np
+
+from dataset_shards import SPLITS, append_shards, file_checksum, save_manifest
+from move_vocab import NUM_MOVES, VOCAB_VERSION, index_to_move, move_to_index
+from pgn_filters import game_split
+
+ARCHIVE_MANIFEST_NAME = "manifest.json"
+ARCHIVE_VERSION = 1
+DEFAULT_BATCH_GAMES = 1000  # Games replayed per task when positions are materialized
+
+
+# Function to create the manifest of an empty game archive
+def new_archive_manifest():
+    return {"version": ARCHIVE_VERSION, "vocab_version": VOCAB_VERSION, "total_games": 0, "total_moves": 0,
+            "chunks": [], "sources": {}}
+
+
+# Function to load the manifest of a game archive (an empty manifest if the archive does not exist yet)
+def load_archive_manifest(archive_dir):
+    manifest_path = os.path.join(archive_dir, ARCHIVE_MANIFEST_NAME)
+    if not os.path.exists(manifest_path):
+        return new_archive_manifest()
+    with open(manifest_path) as f:
+        manifest = json.load(f)
+    if manifest.get("version") != ARCHIVE_VERSION:
+        raise ValueError(f"Unsupported game archive version in {manifest_path}: {manifest.get('version')}")
+    return manifest
+
+
+# Buffer that collects whole games as their move indices instead of encoded positions, with the same
+# interface as PositionBuffer. Also records the split of every game and the FEN of games that do not
+# start from the standard position
+class GameBuffer:
+    def __init__(self, capacity=1 << 16, split_fractions=None):
+        self.moves = np.empty(capacity, dtype=np.int16)
+        self.split_fractions = split_fractions
+        self.lengths, self.splits, self.fens = [], [], []
+        self.sampling = False  # Archives keep whole games
+        self.rows = 0
+
+    def begin_game(self, headers):
+        self.lengths.append(0)
+        self.splits.append(game_split(headers, *self.split_fractions) if self.split_fractions else 0)
+        self.fens.append(headers.get("FEN", ""))
+
+    def append(self, board, move):
+        if self.rows == len(self.moves):
+            self.moves = np.concatenate((self.moves, np.empty_like(self.moves)))
+        self.moves[self.rows] = move_to_index(move)
+        self.lengths[-1] += 1
+        self.rows += 1
+
+    # Append the moves of a finished game, given the board after its last move and the number of plies played
+    def append_finished_game(self, board, num_plies):
+        moves = [board.pop() for _ in range(num_plies)]
+        for move in reversed(moves):
+            self.append(board, move)
+
+    # Returns the buffered games by array name: y (the move indices of all games), and per game its
+    # length, split code and FEN ("" for the standard start)
+    def encoded(self):
+        return {"y": self.moves[:self.rows], "lengths": np.array(self.lengths, dtype=np.int32),
+                "split": np.array(self.splits, dtype=np.uint8), "fens": np.array(self.fens, dtype=object)}
+
+    def clear(self):
+        self.rows = 0
+        self.lengths, self.splits, self.fens = [], [], []
+
+
+# Function to append games (arrays as returned by GameBuffer.encoded) to a game archive as a new chunk.
+# sources maps input files to their updated ingestion records, saved together with the chunk
+def append_games(archive_dir, arrays, sources=None):
+    os.makedirs(archive_dir, exist_ok=True)
+    manifest = load_archive_manifest(archive_dir)
+    if manifest["vocab_version"] != VOCAB_VERSION:
+        raise ValueError(f"Cannot append moves of vocabulary {VOCAB_VERSION} to an archive using "
+                         f"vocabulary {manifest['vocab_version']}")
+
+    num_games = len(arrays["lengths"])
+    if num_games:
+        index = len(manifest["chunks"])
+        chunk = {"index": index, "games": num_games, "moves": len(arrays["y"]), "files": {},
+                 "fens": {str(game): fen for game, fen in enumerate(arrays["fens"]) if fen}}
+        offsets = np.concatenate(([0], np.cumsum(arrays["lengths"], dtype=np.int64)))
+        for name, array in (("moves", arrays["y"]), ("offsets", offsets), ("split", arrays["split"])):
+            file_name = f"{name}_{index:05d}.npy"
+            path = os.path.join(archive_dir, file_name)
+            np.save(path, array)
+            chunk["files"][name] = {"name": file_name, "crc32": file_checksum(path)}
+        manifest["chunks"].append(chunk)
+        manifest["total_games"] += num_games
+        manifest["total_moves"] += chunk["moves"]
+
+    manifest["sources"].update(sources or {})
+    save_manifest(archive_dir, manifest)
+    return manifest
+
+
+# Read-only view of a game archive. The chunks are memory-mapped, so opening an archive reads nothing
+# but the manifest; positions are only reconstructed when they are asked for
+class GameArchive:
+    def __init__(self, archive_dir):
+        self.archive_dir = archive_dir
+        self.manifest = load_archive_manifest(archive_dir)
+        chunks = self.manifest["chunks"]
+        self.moves = [self.load(chunk, "moves") for chunk in chunks]
+        self.offsets = [self.load(chunk, "offsets") for chunk in chunks]
+        self.splits = [self.load(chunk, "split") for chunk in chunks]
+        self.bounds = np.cumsum([0] + [chunk["games"] for chunk in chunks])
+
+    def load(self, chunk, name):
+        return np.load(os.path.join(self.archive_dir, chunk["files"][name]["name"]), mmap_mode="r")
+
+    def __len__(self):
+        return int(self.bounds[-1])
+
+    # Returns the move indices, split code and starting FEN of game number game
+    def game(self, game):
+        chunk = int(np.searchsorted(self.bounds, game, side="right")) - 1
+        local = game - self.bounds[chunk]
+        start, end = self.offsets[chunk][local], self.offsets[chunk][local + 1]
+        fen = self.manifest["chunks"][chunk]["fens"].get(str(local), "")
+        return np.asarray(self.moves[chunk][start:end]), int(self.splits[chunk][local]), fen
+
+    # Replay a range of games and encode every position. Returns the PositionBuffer arrays plus the
+    # split code of every position
+    def positions(self, first_game, last_game, **encode_options):
+        from data_preprocessing import PositionBuffer
+
+        buffer = PositionBuffer(**encode_options)
+        splits = []
+        for game in range(first_game, last_game):
+            moves, split, fen = self.game(game)
+            board = chess.Board(fen) if fen else chess.Board()
+            board.chess960 = board.has_chess960_castling_rights()
+            for index in moves:
+                move = index_to_move(index)
+                buffer.append(board, move)
+                board.push(move)
+            splits.append(np.full(len(moves), split, dtype=np.uint8))
+
+        arrays = {name: array.copy() for name, array in buffer.encoded().items()}
+        arrays["split"] = np.concatenate(splits) if splits else np.empty(0, dtype=np.uint8)
+        return arrays
+
+    # Materialize the positions of all games in batches of batch_games games,
+    # replayed in worker processes. Batches are yielded in archive order
+    def iter_positions(self, batch_games=DEFAULT_BATCH_GAMES, workers=1, **encode_options):
+        tasks = [(self.archive_dir, first, min(first + batch_games, len(self)), encode_options)
+                 for first in range(0, len(self), batch_games)]
+        if workers > 1:
+            with multiprocessing.Pool(workers) as pool:
+                yield from pool.imap(replay_games, tasks)
+        else:
+            yield from map(replay_games, tasks)
+
+
+# Worker function: replay a range of games of an archive and encode their positions
+def replay_games(task):
+    archive_dir, first_game, last_game, encode_options = task
+    return GameArchive(archive_dir).positions(first_game, last_game, **encode_options)
+
+
+# Function to materialize the positions of a game archive as a sharded dataset
+def expand_archive(archive_dir, dataset_dir, batch_games=DEFAULT_BATCH_GAMES, workers=1, **encode_options):
+    archive = GameArchive(archive_dir)
+    for arrays in archive.iter_positions(batch_games, workers, **encode_options):
+        splits = arrays.pop("split")
+        append_shards(dataset_dir, arrays, vocab_version=VOCAB_VERSION, num_classes=NUM_MOVES, splits=splits)
+    return archive
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect a game archive or expand it into a sharded dataset.")
+    parser.add_argument("archive_dir", nargs="?", default="data/games", help="Game archive directory")
+    parser.add_argument("dataset_dir", nargs="?", default=None, help="Write the archive's positions to this dataset")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes replaying games")
+    parser.add_argument("--packed", action="store_true", help="Store positions bit-packed (96 bytes each)")
+    args = parser.parse_args()
+
+    archive = GameArchive(args.archive_dir)
+    manifest = archive.manifest
+    archive_bytes = sum(os.path.getsize(os.path.join(args.archive_dir, entry["name"]))
+                        for chunk in manifest["chunks"] for entry in chunk["files"].values())
+    print(f"{args.archive_dir}: {manifest['total_games']} games, {manifest['total_moves']} positions, "
+          f"{archive_bytes / max(manifest['total_moves'], 1):.2f} bytes per position")
+    split_codes = np.concatenate(archive.splits) if archive.splits else np.empty(0, dtype=np.uint8)
+    for code, split in enumerate(SPLITS):
+        print(f"  {split}: {int(np.sum(split_codes == code))} games")
+
+    if args.dataset_dir:
+        expand_archive(args.archive_dir, args.dataset_dir, workers=args.workers, packed=args.packed)
+        print(f"Wrote the positions of {manifest['total_games']} games to {args.dataset_dir}")
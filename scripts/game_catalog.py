@@ -0,0 +1,260 @@
+import argparse
+import json
+import multiprocessing
+import os
+import sqlite3
+
+import chess.pgn
+import numpy as np
+
+from data_preprocessing import PositionBuffer, read_encoded_game
+from dataset_shards import append_shards
+from move_vocab import NUM_MOVES, VOCAB_VERSION
+from pgn_filters import parse_rating, parse_time_control
+from pgn_index import load_pgn_index
+from pgn_sources import ingested_games, is_compressed, source_fingerprint, source_key
+
+CATALOG_VERSION = 1
+DEFAULT_CHUNK_GAMES = 10000  # Games whose headers are read per catalog task
+DEFAULT_BATCH_GAMES = 1000  # Games encoded per extraction task
+
+# Columns of the games table read straight from a header tag. Dates, ratings and time controls are parsed
+# into their own columns, and all other tags are kept as JSON in other_headers
+TEXT_COLUMNS = {"event": "Event", "site": "Site", "white": "White", "black": "Black", "result": "Result",
+                "eco": "ECO", "opening": "Opening", "time_control": "TimeControl", "termination": "Termination"}
+PARSED_TAGS = {"Date", "UTCDate", "WhiteElo", "BlackElo"}
+GAME_COLUMNS = ("file_id", "game", "byte_offset", *TEXT_COLUMNS, "date", "white_elo", "black_elo",
+                "base_seconds", "increment_seconds", "other_headers")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT UNIQUE NOT NULL,
+    size INTEGER, mtime_ns INTEGER, head_crc32 TEXT, tail_crc32 TEXT,
+    cataloged_games INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS games (
+    file_id INTEGER NOT NULL REFERENCES files (id),
+    game INTEGER NOT NULL,
+    byte_offset INTEGER NOT NULL,
+    event TEXT, site TEXT, white TEXT, black TEXT, result TEXT, eco TEXT, opening TEXT, time_control TEXT,
+    termination TEXT, date TEXT, white_elo INTEGER, black_elo INTEGER, base_seconds INTEGER,
+    increment_seconds INTEGER, other_headers TEXT,
+    PRIMARY KEY (file_id, game)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS games_white_elo ON games (white_elo);
+CREATE INDEX IF NOT EXISTS games_black_elo ON games (black_elo);
+CREATE INDEX IF NOT EXISTS games_eco ON games (eco);
+CREATE INDEX IF NOT EXISTS games_date ON games (date);
+CREATE INDEX IF NOT EXISTS games_white ON games (white);
+CREATE INDEX IF NOT EXISTS games_black ON games (black);
+"""
+
+
+# Function to open (and create if needed) a game catalog database
+def open_catalog(catalog_path):
+    os.makedirs(os.path.dirname(catalog_path) or ".", exist_ok=True)
+    connection = sqlite3.connect(catalog_path)
+    version = connection.execute("PRAGMA user_version").fetchone()[0]
+    if version not in (0, CATALOG_VERSION):
+        raise ValueError(f"Unsupported game catalog version in {catalog_path}: {version}")
+    connection.execute("PRAGMA journal_mode = WAL")
+    connection.executescript(SCHEMA)
+    connection.execute(f"PRAGMA user_version = {CATALOG_VERSION}")
+    return connection
+
+
+# Function to turn the headers of a game into a row of the games table
+def catalog_row(file_id, game, byte_offset, headers):
+    time_control = parse_time_control(headers.get("TimeControl", "")) or (None, None)
+    other_headers = {tag: value for tag, value in headers.items()
+                     if tag not in PARSED_TAGS and tag not in TEXT_COLUMNS.values()}
+    return (file_id, game, byte_offset, *(headers.get(tag) for tag in TEXT_COLUMNS.values()),
+            headers.get("UTCDate") or headers.get("Date"), parse_rating(headers.get("WhiteElo")),
+            parse_rating(headers.get("BlackElo")), *time_control, json.dumps(other_headers) if other_headers else None)
+
+
+# Worker function: read the headers of a range of games (their movetext is skipped unparsed) and return
+# (file_id, end_game, rows)
+def read_catalog_rows(task):
+    pgn_file, file_id, first_game, offsets = task
+    rows = []
+    with open(pgn_file) as pgn:
+        pgn.seek(int(offsets[0]))
+        for game, byte_offset in enumerate(offsets, first_game):
+            headers = chess.pgn.read_headers(pgn)
+            if headers is None:
+                break
+            rows.append(catalog_row(file_id, game, int(byte_offset), headers))
+    return file_id, first_game + len(offsets), rows
+
+
+# Function to register a PGN file in the catalog and get the first game still to be cataloged. Files that
+# changed other than by appending games are cataloged again from the start
+def register_catalog_file(connection, pgn_file):
+    key = source_key(pgn_file)
+    row = connection.execute("SELECT id, size, mtime_ns, head_crc32, tail_crc32, cataloged_games FROM files "
+                             "WHERE path = ?", (key,)).fetchone()
+    start_game = 0
+    if row is not None:
+        record = dict(zip(("size", "mtime_ns", "head_crc32", "tail_crc32", "games"), row[1:]))
+        start_game = ingested_games({key: record}, pgn_file)
+        if start_game is None:
+            print(f"{pgn_file} changed since it was cataloged, cataloging it again")
+            connection.execute("DELETE FROM games WHERE file_id = ?", (row[0],))
+            start_game = 0
+
+    fingerprint = source_fingerprint(pgn_file)
+    connection.execute("INSERT INTO files (path, size, mtime_ns, head_crc32, tail_crc32, cataloged_games) "
+                       "VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (path) DO UPDATE SET size = excluded.size, "
+                       "mtime_ns = excluded.mtime_ns, head_crc32 = excluded.head_crc32, "
+                       "tail_crc32 = excluded.tail_crc32, cataloged_games = excluded.cataloged_games",
+                       (key, fingerprint["size"], fingerprint["mtime_ns"], fingerprint["head_crc32"],
+                        fingerprint["tail_crc32"], start_game))
+    connection.commit()
+    file_id = connection.execute("SELECT id FROM files WHERE path = ?", (key,)).fetchone()[0]
+    return file_id, start_game
+
+
+# Function to add the games of PGN files to a catalog. Files are indexed and their headers read in worker
+# processes, in chunks of chunk_games games. Every chunk is committed with the file's progress, so an
+# interrupted build resumes where it stopped, and files that are already cataloged are only checked
+# for appended games
+def build_catalog(catalog_path, pgn_files, workers=1, chunk_games=DEFAULT_CHUNK_GAMES):
+    connection = open_catalog(catalog_path)
+    plain_files = []
+    for pgn_file in pgn_files:
+        if is_compressed(pgn_file):
+            print(f"Skipping {pgn_file}: compressed files cannot be seeked, decompress it to catalog it")
+        else:
+            plain_files.append(pgn_file)
+
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    offsets_per_file = (pool.map if pool is not None else map)(load_pgn_index, plain_files)
+    tasks = []
+    for pgn_file, offsets in zip(plain_files, offsets_per_file):
+        file_id, start_game = register_catalog_file(connection, pgn_file)
+        tasks.extend((pgn_file, file_id, first, offsets[first:first + chunk_games])
+                     for first in range(start_game, len(offsets), chunk_games))
+
+    placeholders = ", ".join("?" * len(GAME_COLUMNS))
+    cataloged = 0
+    try:
+        for file_id, end_game, rows in (pool.imap if pool is not None else map)(read_catalog_rows, tasks):
+            connection.executemany(f"INSERT OR REPLACE INTO games ({', '.join(GAME_COLUMNS)}) "
+                                   f"VALUES ({placeholders})", rows)
+            connection.execute("UPDATE files SET cataloged_games = ? WHERE id = ?", (end_game, file_id))
+            connection.commit()
+            cataloged += len(rows)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return connection, cataloged
+
+
+# Function to check which cataloged files can still be read at their cataloged offsets (unchanged, or
+# changed only by appending games)
+def readable_catalog_files(connection):
+    readable = set()
+    for path, size, mtime_ns, head_crc32, tail_crc32, games in connection.execute(
+            "SELECT path, size, mtime_ns, head_crc32, tail_crc32, cataloged_games FROM files"):
+        record = {"size": size, "mtime_ns": mtime_ns, "head_crc32": head_crc32, "tail_crc32": tail_crc32, "games": games}
+        if os.path.exists(path) and ingested_games({path: record}, path) is not None:
+            readable.add(path)
+    return readable
+
+
+# Generator of extraction tasks: the byte offsets of the games matching the query, batch_games at a time
+# and grouped by file, in catalog order. Offsets are int64 arrays, so a task list stays small
+def iter_extraction_tasks(connection, where, params, limit, batch_games, encode_options):
+    query = (f"SELECT files.path, games.byte_offset FROM games JOIN files ON files.id = games.file_id "
+             f"WHERE {where} ORDER BY games.file_id, games.game")
+    if limit is not None:
+        query += f" LIMIT {int(limit)}"
+    readable = readable_catalog_files(connection)
+    path, offsets = None, []
+    for game_path, byte_offset in connection.execute(query, params):
+        if game_path != path or len(offsets) == batch_games:
+            if offsets:
+                yield path, np.array(offsets, dtype=np.int64), encode_options
+            if game_path not in readable:
+                raise ValueError(f"{game_path} changed since it was cataloged; rebuild the catalog first")
+            path, offsets = game_path, []
+        offsets.append(byte_offset)
+    if offsets:
+        yield path, np.array(offsets, dtype=np.int64), encode_options
+
+
+# Worker function: seek to each of a list of games of a PGN file and encode their positions
+def encode_catalog_games(task):
+    pgn_file, offsets, encode_options = task
+    buffer = PositionBuffer(**encode_options)
+    with open(pgn_file) as pgn:
+        for byte_offset in offsets:
+            pgn.seek(int(byte_offset))
+            read_encoded_game(pgn, buffer)
+    arrays = {name: array.copy() for name, array in buffer.encoded().items()}
+    arrays["games"] = len(offsets)
+    return arrays
+
+
+# Function to write the positions of the cataloged games matching an SQL condition on the games table
+# (e.g. "white_elo >= 2000 AND eco LIKE 'B%'") to a sharded dataset. Only the matching games are read:
+# every one is reached by seeking to its byte offset. Returns the number of games extracted
+def extract_games(catalog_path, where, dataset_dir, params=(), limit=None, workers=1,
+                  batch_games=DEFAULT_BATCH_GAMES, **encode_options):
+    connection = open_catalog(catalog_path)
+    # The query runs before any worker starts (a connection can only be used by the thread that opened it)
+    tasks = list(iter_extraction_tasks(connection, where, params, limit, batch_games, encode_options))
+    pool = multiprocessing.Pool(workers) if workers > 1 else None
+    extracted = 0
+    try:
+        for arrays in (pool.imap if pool is not None else map)(encode_catalog_games, tasks):
+            extracted += arrays.pop("games")
+            splits = arrays.pop("split", None)
+            append_shards(dataset_dir, arrays, vocab_version=VOCAB_VERSION, num_classes=NUM_MOVES, splits=splits)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return extracted
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Catalog the headers of PGN games in SQLite and extract "
+                                                 "datasets of the games matching a query.")
+    parser.add_argument("--catalog", default="data/catalog.sqlite", help="Catalog database")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    build = commands.add_parser("build", help="Add the games of PGN files to the catalog")
+    build.add_argument("pgn_files", nargs="+", help="Uncompressed PGN files")
+    build.add_argument("--workers", type=int, default=1, help="Number of worker processes reading headers")
+
+    count = commands.add_parser("count", help="Count the cataloged games matching a query")
+    count.add_argument("where", help="SQL condition on the games table, e.g. \"white_elo >= 2000 AND eco LIKE 'B%%'\"")
+
+    extract = commands.add_parser("extract", help="Write the positions of the matching games to a dataset")
+    extract.add_argument("where", help="SQL condition on the games table, e.g. \"white_elo >= 2000 AND eco LIKE 'B%%'\"")
+    extract.add_argument("dataset_dir", help="Dataset to write (appended to if it exists)")
+    extract.add_argument("--limit", type=int, default=None, help="Extract at most this many games")
+    extract.add_argument("--workers", type=int, default=1, help="Number of worker processes encoding games")
+    extract.add_argument("--packed", action="store_true", help="Store positions bit-packed (96 bytes each)")
+    extract.add_argument("--zobrist", action="store_true", help="Also store the Zobrist key of every position")
+    extract.add_argument("--legal-masks", action="store_true", help="Also store the legal-move mask of every position")
+    extract.add_argument("--val-fraction", type=float, default=0.05, help="Fraction of games assigned to the validation split")
+    extract.add_argument("--test-fraction", type=float, default=0.05, help="Fraction of games assigned to the test split")
+    args = parser.parse_args()
+
+    if args.command == "build":
+        connection, cataloged = build_catalog(args.catalog, args.pgn_files, args.workers)
+        total = connection.execute("SELECT COUNT(*) FROM games").fetchone()[0]
+        print(f"Cataloged {cataloged} new games ({total} games in {args.catalog})")
+    elif args.command == "count":
+        connection = open_catalog(args.catalog)
+        print(connection.execute(f"SELECT COUNT(*) FROM games WHERE {args.where}").fetchone()[0])
+    else:
+        extracted = extract_games(args.catalog, args.where, args.dataset_dir, limit=args.limit, workers=args.workers,
+                                  packed=args.packed, zobrist=args.zobrist, legal_masks=args.legal_masks,
+                                  split_fractions=(args.val_fraction, args.test_fraction))
+        print(f"Extracted {extracted} games to {args.dataset_dir}")
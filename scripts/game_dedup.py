@@ -0,0 +1,133 @@
+import argparse
+import hashlib
+import os
+
+import numpy as np
+
+HASHES_NAME = "game_hashes.npy"  # Sorted keys of all games recorded so far
+LOG_NAME = "game_hashes.log"  # Keys recorded since the last compaction, appended after every batch
+SNAPSHOT_NAME = "game_hashes.recent.npy"  # Sorted copy of the logged keys, memory-mapped by worker processes
+COMPACT_KEYS = 1 << 20  # Logged keys merged into the sorted file once there are this many
+MOVES_HASH_MULTIPLIER = 0x9E3779B97F4A7C15
+MOVES_HASH_MASK = (1 << 64) - 1
+STANDARD_START_HASH = 0x6A09E667F3BCC908
+
+# Returned by read_encoded_game for games whose moves repeat a game already seen
+DUPLICATE = "duplicate"
+
+
+# Function to get the initial moves hash of a game from its FEN header ("" for the standard start), so the
+# same moves played from different positions give different keys
+def start_moves_hash(fen):
+    if not fen:
+        return STANDARD_START_HASH
+    return int.from_bytes(hashlib.blake2b(fen.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+# Function to extend a rolling 64-bit hash of a game's mainline by one move
+def extend_moves_hash(key, move):
+    code = move.from_square | move.to_square << 6 | (move.promotion or 0) << 12
+    return (key * MOVES_HASH_MULTIPLIER + code + 1) & MOVES_HASH_MASK
+
+
+# Function to memory-map a file of sorted keys (an empty array if it does not exist)
+def load_sorted_keys(path):
+    return np.load(path, mmap_mode="r") if os.path.exists(path) else np.empty(0, dtype=np.uint64)
+
+
+# Function to binary-search a sorted key array
+def sorted_contains(keys, key):
+    index = np.searchsorted(keys, key)
+    return index < len(keys) and int(keys[index]) == key
+
+
+# Set of the moves hashes of all games ingested into a dataset, persisted in its directory across runs.
+# The bulk of the keys is a sorted uint64 array (8 bytes per game) that is memory-mapped and binary-searched,
+# so it is never loaded whole; keys added since the last compaction are kept in memory and in a log file.
+# Keys added by add() are only written by save(), which is called once the games' batch is saved: a crash
+# in between forgets keys (a later repeat of those games is kept) but never drops a game that was not saved.
+# With snapshot=True (in worker processes) the logged keys are not read from the log into a set but
+# memory-mapped from the sorted copy written by write_snapshot(), so opening the set costs nothing
+class GameHashSet:
+    def __init__(self, directory, snapshot=False):
+        self.directory = directory
+        self.hashes_path = os.path.join(directory, HASHES_NAME)
+        self.log_path = os.path.join(directory, LOG_NAME)
+        self.snapshot_path = os.path.join(directory, SNAPSHOT_NAME)
+        self.sorted_keys = load_sorted_keys(self.hashes_path)
+        self.logged_keys = load_sorted_keys(self.snapshot_path) if snapshot else np.empty(0, dtype=np.uint64)
+        logged = np.fromfile(self.log_path, dtype="<u8") if os.path.exists(self.log_path) and not snapshot else []
+        self.recent = set(int(key) for key in logged)
+        self.snapshot_size = None  # Number of recent keys in the snapshot file, None if it is not up to date
+        self.unsaved = []
+        self.duplicates = 0
+
+    def __len__(self):
+        return len(self.sorted_keys) + len(self.logged_keys) + len(self.recent)
+
+    def __contains__(self, key):
+        return key in self.recent or sorted_contains(self.sorted_keys, key) or sorted_contains(self.logged_keys, key)
+
+    # Add the key of a game. Returns False (and counts a duplicate) if it was already in the set
+    def add(self, key):
+        if key in self:
+            self.duplicates += 1
+            return False
+        self.recent.add(key)
+        self.unsaved.append(key)
+        return True
+
+    # Append the keys added since the last save to the log, merging the log into the sorted keys once it is large
+    def save(self):
+        self.write_log()
+        if len(self.recent) >= COMPACT_KEYS:
+            self.compact()
+
+    # Append the keys added since the last save to the log
+    def write_log(self):
+        if self.unsaved:
+            os.makedirs(self.directory, exist_ok=True)
+            with open(self.log_path, "ab") as f:
+                f.write(np.array(self.unsaved, dtype="<u8").tobytes())
+            self.unsaved = []
+
+    # Merge the logged keys into the sorted keys. The new file replaces the old one before the log is
+    # removed, so an interrupted compaction at worst leaves keys in both
+    def compact(self):
+        self.write_log()
+        os.makedirs(self.directory, exist_ok=True)
+        recent = np.fromiter(self.recent, dtype=np.uint64, count=len(self.recent))
+        self.sorted_keys = np.union1d(self.sorted_keys, recent)
+        temporary_path = self.hashes_path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            np.save(f, self.sorted_keys)
+        os.replace(temporary_path, self.hashes_path)
+        if os.path.exists(self.log_path):
+            os.remove(self.log_path)
+        self.recent = set()
+        self.snapshot_size = None
+
+    # Write the recent keys, sorted, for GameHashSet(directory, snapshot=True) in worker processes. Keys are
+    # only added between compactions, so the file is rewritten only when the number of recent keys changed
+    def write_snapshot(self):
+        if self.snapshot_size == len(self.recent):
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        temporary_path = self.snapshot_path + ".tmp"
+        with open(temporary_path, "wb") as f:
+            np.save(f, np.sort(np.fromiter(self.recent, dtype=np.uint64, count=len(self.recent))))
+        os.replace(temporary_path, self.snapshot_path)
+        self.snapshot_size = len(self.recent)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or compact the game hash set of a dataset.")
+    parser.add_argument("directory", nargs="?", default="data/dataset", help="Dataset or game archive directory")
+    parser.add_argument("--compact", action="store_true", help="Merge the logged keys into the sorted keys")
+    args = parser.parse_args()
+
+    seen_games = GameHashSet(args.directory)
+    print(f"{args.directory}: {len(seen_games)} games ({len(seen_games.recent)} in the log)")
+    if args.compact:
+        seen_games.compact()
+        print(f"Compacted into {seen_games.hashes_path} ({os.path.getsize(seen_games.hashes_path)} bytes)")
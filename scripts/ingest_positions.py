@@ -0,0 +1,195 @@
+import argparse
+import csv
+import gc
+import itertools
+import multiprocessing
+import os
+import re
+
+import chess
+import numpy as np
+
+from board_encoding import set_board_from_fen
+from data_preprocessing import PositionBuffer, save_dataset, save_dicts
+from dataset_shards import load_manifest
+from move_vocab import require_fixed_vocabulary, vocabulary_dicts
+from pgn_sources import DECOMPRESSORS, ingested_games, open_pgn, source_fingerprint, source_key, source_record
+
+FORMATS = ("epd", "csv")
+EPD_BEST_MOVE_REGEX = re.compile(r"(?:^|;)\s*bm\s+([^;]+)")
+FEN_COLUMNS = ("FEN", "fen", "Fen")
+MOVE_COLUMNS = ("Moves", "moves", "Move", "move", "BestMove", "best_move", "bm")
+PUZZLE_COLUMN = "PuzzleId"  # Present in Lichess puzzle exports
+
+
+# Function to get the format of a position file from its extension, ignoring a compression suffix
+# (e.g. lichess_db_puzzle.csv.zst is a CSV file). Returns None for unknown extensions
+def position_file_format(path):
+    for suffix in DECOMPRESSORS:
+        if path.endswith(suffix):
+            path = path[:-len(suffix)]
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    return extension if extension in FORMATS else None
+
+
+# Function to find the FEN and move columns in the header row of a CSV file. Returns
+# (fen column, move column, is a Lichess puzzle export)
+def csv_columns(header_line, path):
+    columns = next(csv.reader([header_line]))
+    fen_column = next((columns.index(name) for name in FEN_COLUMNS if name in columns), None)
+    move_column = next((columns.index(name) for name in MOVE_COLUMNS if name in columns), None)
+    if fen_column is None or move_column is None:
+        raise ValueError(f"{path} needs a FEN column ({', '.join(FEN_COLUMNS)}) and a move column "
+                         f"({', '.join(MOVE_COLUMNS)}), found {columns}")
+    return fen_column, move_column, PUZZLE_COLUMN in columns
+
+
+# Function to parse a move in UCI (as in Lichess puzzles) or SAN (as in EPD bm opcodes)
+def parse_move(board, text):
+    try:
+        return board.parse_uci(text)
+    except ValueError:
+        return board.parse_san(text)
+
+
+# Function to append the positions of one record: the position of fen and each of the moves played from
+# it in turn. Only the moves from first_ply on, every step plies, are recorded. The split is chosen by the
+# position, so the same position lands in the same split in every file
+def append_record(buffer, board, fen, move_texts, first_ply=0, step=1):
+    set_board_from_fen(board, fen)
+    buffer.begin_game({"FEN": " ".join(fen.split()[:4])})
+    for ply, text in enumerate(move_texts):
+        move = parse_move(board, text)
+        if ply >= first_ply and (ply - first_ply) % step == 0:
+            buffer.append(board, move)
+        if ply + 1 < len(move_texts):
+            board.push(move)
+
+
+# Function to append an EPD line, labelled with its first best move (bm). Blank lines are ignored
+def append_epd_record(buffer, board, line):
+    fields = line.split(maxsplit=4)
+    if not fields:
+        return
+    match = EPD_BEST_MOVE_REGEX.search(fields[4]) if len(fields) == 5 else None
+    if match is None:
+        raise ValueError(f"No best move (bm) in EPD line: {line!r}")
+    append_record(buffer, board, " ".join(fields[:4]), match.group(1).split()[:1])
+
+
+# Function to append a CSV row of a FEN and the moves played from it. In Lichess puzzles the first move
+# is the opponent's, played before the puzzle starts, so only the solver's moves are recorded
+def append_csv_record(buffer, board, row, columns):
+    if not row:
+        return
+    fen_column, move_column, puzzle = columns
+    moves = row[move_column].split()
+    if puzzle:
+        append_record(buffer, board, row[fen_column], moves, first_ply=1, step=2)
+    else:
+        append_record(buffer, board, row[fen_column], moves)
+
+
+# Worker function: parse and encode a chunk of lines of a position file. Records that cannot be parsed
+# (or have an illegal move) are skipped and counted; positions before the error are kept, as for PGN games
+def encode_position_lines(task):
+    lines, file_format, columns, encode_options = task
+    buffer = PositionBuffer(**encode_options)
+    board = chess.Board()
+    skipped = 0
+    for record in (csv.reader(lines) if file_format == "csv" else lines):
+        try:
+            if file_format == "csv":
+                append_csv_record(buffer, board, record, columns)
+            else:
+                append_epd_record(buffer, board, record)
+        except (ValueError, IndexError):
+            skipped += 1
+    arrays = {name: array.copy() for name, array in buffer.encoded().items()}
+    arrays["skipped"] = np.array([skipped])
+    return arrays
+
+
+# Generator that reads the lines of a (possibly compressed) position file after its first start_line
+# lines, batch_lines at a time. The header row of a CSV file is not counted as a line
+def iter_line_batches(path, file_format, batch_lines, start_line=0):
+    with open_pgn(path) as f:  # Decompresses like a PGN file; any text file works
+        if file_format == "csv":
+            f.readline()
+        lines = itertools.islice(f, start_line, None)
+        while batch := list(itertools.islice(lines, batch_lines)):
+            yield batch
+
+
+# Generator that parses and encodes a position file batch_lines lines at a time, split between worker
+# processes, and yields (arrays, num_lines, num_skipped) in file order. arrays are the same as for
+# PGN games, so they are saved to the same dataset
+def iter_encoded_position_batches(path, file_format, columns, batch_lines, pool=None, workers=1, start_line=0,
+                                  **encode_options):
+    for lines in iter_line_batches(path, file_format, batch_lines, start_line):
+        chunk_size = -(-len(lines) // workers)  # Ceiling division
+        tasks = [(lines[first:first + chunk_size], file_format, columns, encode_options)
+                 for first in range(0, len(lines), chunk_size)]
+        results = pool.map(encode_position_lines, tasks) if pool is not None else list(map(encode_position_lines, tasks))
+        skipped = sum(int(part.pop("skipped")[0]) for part in results)
+        arrays = {name: np.concatenate([part[name] for part in results], axis=0) for name in results[0]}
+        yield arrays, len(lines), skipped
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Ingest EPD and FEN+move CSV position files into the training dataset.")
+    parser.add_argument("files", nargs="+",
+                        help="EPD (.epd) or CSV (.csv, e.g. the Lichess puzzle export) files, optionally compressed")
+    parser.add_argument("--format", choices=FORMATS, default=None, help="File format (default: from the extension)")
+    parser.add_argument("--batch-lines", type=int, default=1 << 16, help="Number of lines encoded per batch")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes for parsing and encoding")
+    parser.add_argument("--packed", action="store_true", help="Store positions bit-packed (96 bytes each)")
+    parser.add_argument("--zobrist", action="store_true", help="Also store the Zobrist key of every position")
+    parser.add_argument("--legal-masks", action="store_true", help="Also store the legal-move mask of every position")
+    parser.add_argument("--val-fraction", type=float, default=0.05, help="Fraction of positions assigned to the validation split")
+    parser.add_argument("--test-fraction", type=float, default=0.05, help="Fraction of positions assigned to the test split")
+    args = parser.parse_args()
+
+    # Datasets built with the old batch-grown move_dict.json must be remapped before appending to them
+    require_fixed_vocabulary()
+
+    encode_options = {"packed": args.packed, "zobrist": args.zobrist, "legal_masks": args.legal_masks,
+                      "split_fractions": (args.val_fraction, args.test_fraction)}
+    pool = multiprocessing.Pool(args.workers) if args.workers > 1 else None
+
+    for path in args.files:
+        file_format = args.format or position_file_format(path)
+        if file_format is None:
+            parser.error(f"Cannot tell the format of {path}; pass --format")
+        columns = None
+        if file_format == "csv":
+            with open_pgn(path, threaded=False) as f:
+                columns = csv_columns(f.readline(), path)
+
+        # Lines already in the dataset (from an earlier or interrupted run) are not processed again
+        start_line = ingested_games(load_manifest("data/dataset")["sources"], path)
+        if start_line is None:
+            print(f"Skipping {path}: it changed since it was ingested (not only by appending lines)")
+            continue
+        fingerprint = source_fingerprint(path)
+
+        print(f"Processing file: {path} ({file_format}) from line {start_line}")
+        for arrays, num_lines, skipped in iter_encoded_position_batches(path, file_format, columns, args.batch_lines,
+                                                                        pool, args.workers, start_line, **encode_options):
+            print(f"Processed lines {start_line} to {start_line + num_lines} ({len(arrays['y'])} positions"
+                  + (f", {skipped} unreadable lines skipped" if skipped else "") + ")...")
+            start_line += num_lines
+
+            save_dataset(**arrays, sources={source_key(path): source_record(fingerprint, start_line)})
+
+            del arrays
+            gc.collect()
+
+    if pool is not None:
+        pool.close()
+        pool.join()
+
+    # Save the move dictionaries of the fixed vocabulary
+    save_dicts(*vocabulary_dicts())
+
+    print("Position ingestion complete. Files saved in the 'data/' folder.")
@@ -0,0 +1,251 @@
+import json
+import os
+import shutil
+
+import chess
+import numpy as np
+
+VOCAB_VERSION = "fixed-1"
+PROMOTION_PIECES = (chess.KNIGHT, chess.BISHOP, chess.ROOK, chess.QUEEN)
+
+
+# Function to list every geometrically possible UCI move: queen-line and knight moves between any
+# two squares, plus pawn promotions from the 7th to the 8th rank (and 2nd to 1st), sorted by UCI string
+def generate_vocabulary():
+    moves = []
+    for from_square in chess.SQUARES:
+        for to_square in chess.SQUARES:
+            file_distance = abs(chess.square_file(from_square) - chess.square_file(to_square))
+            rank_distance = abs(chess.square_rank(from_square) - chess.square_rank(to_square))
+            if from_square == to_square:
+                continue
+            if file_distance == 0 or rank_distance == 0 or file_distance == rank_distance \
+                    or {file_distance, rank_distance} == {1, 2}:
+                moves.append(chess.Move(from_square, to_square))
+
+            # Promotions: one step forward (or a diagonal capture) onto the last rank
+            if rank_distance == 1 and file_distance <= 1 and (
+                    chess.square_rank(from_square), chess.square_rank(to_square)) in ((6, 7), (1, 0)):
+                moves.extend(chess.Move(from_square, to_square, promotion=piece) for piece in PROMOTION_PIECES)
+    return sorted(move.uci() for move in moves)
+
+
+MOVE_UCIS = tuple(generate_vocabulary())
+NUM_MOVES = len(MOVE_UCIS)  # 1968
+LEGAL_MASK_BYTES = -(-NUM_MOVES // 8)  # 246 bytes per bit-packed legal-move mask
+
+# Lookup tables: MOVE_INDEX[from_square, to_square, promotion piece type or 0] is the move index
+# (-1 for moves outside the vocabulary), and MOVE_FROM/MOVE_TO/MOVE_PROMOTION invert it
+MOVE_INDEX = np.full((64, 64, 7), -1, dtype=np.int16)
+MOVE_FROM = np.empty(NUM_MOVES, dtype=np.uint8)
+MOVE_TO = np.empty(NUM_MOVES, dtype=np.uint8)
+MOVE_PROMOTION = np.zeros(NUM_MOVES, dtype=np.uint8)
+for _index, _uci in enumerate(MOVE_UCIS):
+    _move = chess.Move.from_uci(_uci)
+    MOVE_INDEX[_move.from_square, _move.to_square, _move.promotion or 0] = _index
+    MOVE_FROM[_index], MOVE_TO[_index] = _move.from_square, _move.to_square
+    MOVE_PROMOTION[_index] = _move.promotion or 0
+
+# Permutation of move indices for color-flipped positions: every move mirrored vertically (e2e4 -> e7e5).
+# The vocabulary is closed under the mirror, and the table is its own inverse
+FLIP_MOVES = MOVE_INDEX[MOVE_FROM ^ 56, MOVE_TO ^ 56, MOVE_PROMOTION]
+
+
+# Function to get the vocabulary index of a move
+def move_to_index(move):
+    index = MOVE_INDEX[move.from_square, move.to_square, move.promotion or 0]
+    if index < 0:
+        raise ValueError(f"Move {move.uci()} is not in the move vocabulary")
+    return int(index)
+
+
+# Function to check if a move is in the vocabulary (null moves, written "--" in PGN, are not)
+def in_vocabulary(move):
+    return MOVE_INDEX[move.from_square, move.to_square, move.promotion or 0] >= 0
+
+
+# Function to get the legal moves of a board as a bit-packed mask over the vocabulary
+# (LEGAL_MASK_BYTES bytes, bit i of the little-endian bit string is set if move i is legal)
+def legal_move_mask(board):
+    moves = list(board.legal_moves)
+    indices = MOVE_INDEX[[move.from_square for move in moves], [move.to_square for move in moves],
+                         [move.promotion or 0 for move in moves]]
+    bits = np.zeros(LEGAL_MASK_BYTES * 8, dtype=bool)
+    bits[indices] = True
+    return np.packbits(bits, bitorder="little")
+
+
+# Function to unpack bit-packed legal-move masks into an (N, NUM_MOVES) boolean array
+def unpack_legal_masks(masks):
+    return np.unpackbits(np.asarray(masks), axis=-1, count=NUM_MOVES, bitorder="little").astype(bool)
+
+
+# Function to get the move with a given vocabulary index
+def index_to_move(index):
+    return chess.Move(int(MOVE_FROM[index]), int(MOVE_TO[index]), promotion=int(MOVE_PROMOTION[index]) or None)
+
+
+# Function to get the vocabulary as move_dict/reverse_move_dict dictionaries (the JSON file format)
+def vocabulary_dicts():
+    move_dict = {uci: index for index, uci in enumerate(MOVE_UCIS)}
+    reverse_move_dict = {index: uci for index, uci in enumerate(MOVE_UCIS)}
+    return move_dict, reverse_move_dict
+
+
+# Function to build a table that maps the labels of an old, batch-grown move_dict onto the fixed vocabulary
+def remap_move_dict(move_dict):
+    table = np.full(max(move_dict.values()) + 1, -1, dtype=np.int16)
+    for uci, old_index in move_dict.items():
+        table[old_index] = move_to_index(chess.Move.from_uci(uci))
+    return table
+
+
+# Function to check if a move_dict numbers the moves exactly like the fixed vocabulary
+def is_fixed_move_dict(move_dict):
+    return len(move_dict) == NUM_MOVES and all(move_dict.get(uci) == index for index, uci in enumerate(MOVE_UCIS))
+
+
+# Function to get the path the batch-grown move_dict.json next to move_dict_path is backed up to
+def dynamic_move_dict_path(move_dict_path):
+    return os.path.join(os.path.dirname(move_dict_path), "move_dict.dynamic.json")
+
+
+# Function to copy a batch-grown move_dict.json to move_dict.dynamic.json before it is overwritten with the
+# fixed vocabulary: labels numbered with it can only be remapped with it. A backup is only replaced by a
+# dictionary that extends it (batch-grown dictionaries only ever add moves); any other one is kept under a
+# numbered name. Returns the backup path, or None if there was nothing to back up
+def backup_move_dict(move_dict_path):
+    if not os.path.exists(move_dict_path):
+        return None
+    with open(move_dict_path) as f:
+        move_dict = json.load(f)
+    if is_fixed_move_dict(move_dict):
+        return None
+
+    backup_path = dynamic_move_dict_path(move_dict_path)
+    if os.path.exists(backup_path):
+        with open(backup_path) as f:
+            backup = json.load(f)
+        if any(move_dict.get(uci) != index for uci, index in backup.items()):
+            number = 1
+            while os.path.exists(f"{backup_path[:-len('.json')]}.{number}.json"):
+                number += 1
+            backup_path = f"{backup_path[:-len('.json')]}.{number}.json"
+    shutil.copyfile(move_dict_path, backup_path)
+    return backup_path
+
+
+# Function to load the batch-grown move_dict labels were built with: move_dict_path, or its backup if
+# move_dict_path was already overwritten with the fixed vocabulary
+def load_dynamic_move_dict(move_dict_path):
+    with open(move_dict_path) as f:
+        move_dict = json.load(f)
+    if not is_fixed_move_dict(move_dict):
+        return move_dict
+    backup_path = dynamic_move_dict_path(move_dict_path)
+    if not os.path.exists(backup_path):
+        raise ValueError(f"{move_dict_path} holds the fixed vocabulary and there is no {backup_path}; "
+                         "pass the move_dict.json the labels were built with")
+    with open(backup_path) as f:
+        return json.load(f)
+
+
+# Function to get the label file written by versions before the sharded dataset (y.npy, one-hot rows or
+# move indices of a batch-grown move_dict) in data_dir, or None
+def legacy_labels_path(data_dir):
+    path = os.path.join(data_dir, "y.npy")
+    return path if os.path.exists(path) else None
+
+
+# Function to stop a script before it adds data to a dataset whose labels use an old, batch-grown move_dict
+# (its shards, or without shards the X.npy/y.npy files of older versions in data_dir): they must be remapped
+# onto the fixed vocabulary first
+def require_fixed_vocabulary(dataset_dir="data/dataset", data_dir="data"):
+    from dataset_shards import load_manifest
+
+    manifest = load_manifest(dataset_dir)
+    if manifest["shards"] and manifest["vocab_version"] != VOCAB_VERSION or \
+            not manifest["shards"] and legacy_labels_path(data_dir):
+        raise SystemExit(f"{dataset_dir} (or {data_dir}/y.npy) uses labels from an old move_dict.json; remap it "
+                         f"first with 'python scripts/move_vocab.py {dataset_dir} {data_dir}/move_dict.json'")
+
+
+# Function to convert the X.npy (or X_packed.npy) and y.npy files of older versions into a sharded dataset
+# with fixed-vocabulary labels, one shard at a time. The dataset is written to a temporary directory that
+# replaces dataset_dir at the end, so an interrupted conversion can simply be run again
+def convert_legacy_dataset(data_dir, dataset_dir, table):
+    from dataset_shards import DEFAULT_SHARD_ROWS, append_shards
+
+    packed_path = os.path.join(data_dir, "X_packed.npy")
+    X = np.load(packed_path if os.path.exists(packed_path) else os.path.join(data_dir, "X.npy"), mmap_mode="r")
+    y = np.load(legacy_labels_path(data_dir), mmap_mode="r")
+    if len(X) != len(y):
+        raise ValueError(f"{data_dir} holds {len(X)} positions but {len(y)} labels")
+
+    temporary_dir = dataset_dir.rstrip(os.sep) + ".tmp"
+    shutil.rmtree(temporary_dir, ignore_errors=True)
+    for start in range(0, len(y), DEFAULT_SHARD_ROWS):
+        labels = np.asarray(y[start:start + DEFAULT_SHARD_ROWS])
+        if labels.ndim == 2:
+            labels = np.argmax(labels, axis=1)
+        append_shards(temporary_dir, {"X": np.asarray(X[start:start + DEFAULT_SHARD_ROWS]), "y": table[labels]},
+                      vocab_version=VOCAB_VERSION, num_classes=NUM_MOVES)
+    shutil.rmtree(dataset_dir, ignore_errors=True)  # Holds no shards, at most an empty manifest
+    os.replace(temporary_dir, dataset_dir)
+
+
+# Function to move the labels of a dataset built with an old move_dict onto the fixed vocabulary: the labels
+# of a sharded dataset are rewritten into new files, and without shards the X.npy/y.npy files of older versions
+# next to move_dict.json are converted into a sharded dataset. move_dict.json is then replaced with the
+# fixed vocabulary (the old one is kept as move_dict.dynamic.json)
+def remap_dataset(dataset_dir, move_dict_path):
+    from dataset_shards import file_checksum, load_manifest, save_manifest, shard_path
+
+    manifest = load_manifest(dataset_dir)
+    dict_dir = os.path.dirname(move_dict_path) or "."
+    if manifest["shards"] and manifest["vocab_version"] == VOCAB_VERSION:
+        print(f"{dataset_dir} already uses the {VOCAB_VERSION} move vocabulary")
+        return manifest
+    if not manifest["shards"] and legacy_labels_path(dict_dir) is None:
+        raise FileNotFoundError(f"No shards in {dataset_dir} and no y.npy in {dict_dir} to remap")
+
+    table = remap_move_dict(load_dynamic_move_dict(move_dict_path))
+    if manifest["shards"]:
+        # The remapped labels go to new files that replace the old ones in a single manifest update, so an
+        # interrupted remap leaves the dataset untouched and can be run again (remapping twice would not be)
+        old_paths = []
+        for shard in manifest["shards"]:
+            path = shard_path(dataset_dir, shard, "y")
+            file_name = f"{os.path.basename(path)[:-len('.npy')]}.{VOCAB_VERSION}.npy"
+            np.save(os.path.join(dataset_dir, file_name), table[np.load(path)])
+            shard["files"]["y"] = {"name": file_name, "crc32": file_checksum(os.path.join(dataset_dir, file_name))}
+            old_paths.append(path)
+        manifest["vocab_version"] = VOCAB_VERSION
+        manifest["num_classes"] = NUM_MOVES
+        save_manifest(dataset_dir, manifest)
+        for path in old_paths:
+            os.remove(path)
+    else:
+        convert_legacy_dataset(dict_dir, dataset_dir, table)
+        manifest = load_manifest(dataset_dir)
+
+    # Replace the dictionaries next to move_dict.json with the fixed vocabulary
+    backup_move_dict(move_dict_path)
+    move_dict, reverse_move_dict = vocabulary_dicts()
+    with open(os.path.join(dict_dir, "move_dict.json"), "w") as f:
+        json.dump(move_dict, f)
+    with open(os.path.join(dict_dir, "reverse_move_dict.json"), "w") as f:
+        json.dump(reverse_move_dict, f)
+    return manifest
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Remap a dataset (or the X.npy/y.npy files of older versions) built with an old move_dict.json onto the fixed move vocabulary.")
+    parser.add_argument("dataset_dir", nargs="?", default="data/dataset", help="Sharded dataset directory")
+    parser.add_argument("move_dict", nargs="?", default="data/move_dict.json", help="The move_dict.json the dataset was built with")
+    args = parser.parse_args()
+
+    manifest = remap_dataset(args.dataset_dir, args.move_dict)
+    print(f"{args.dataset_dir}: {manifest['total_rows']} labels use the {VOCAB_VERSION} vocabulary ({NUM_MOVES} moves)")
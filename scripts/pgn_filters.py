@@ -0,0 +1,73 @@
+import hashlib
+
+from dataset_shards import SPLITS
+
+BULLET_SECONDS = 180  # Lichess: games with an estimated duration below 3 minutes are bullet
+
+# Returned by read_encoded_game (data_preprocessing.py) for games whose headers were rejected
+REJECTED = "rejected"
+
+
+# Function to parse a TimeControl header such as "300+3" into (base seconds, increment seconds).
+# Returns None for correspondence games ("-") and for unknown or malformed values
+def parse_time_control(value):
+    base, _, increment = value.partition("+")
+    try:
+        return int(base), int(increment or 0)
+    except ValueError:
+        return None
+
+
+# Function to parse an Elo header, returning None if it is missing or unknown ("?")
+def parse_rating(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+# Filter deciding from the headers alone whether a game is used. A plain class (not a closure),
+# so it can be sent to worker processes
+class HeaderFilter:
+    def __init__(self, min_rating=None, min_estimated_seconds=None, results=None):
+        self.min_rating = min_rating
+        self.min_estimated_seconds = min_estimated_seconds
+        self.results = set(results) if results else None
+
+    def __call__(self, headers):
+        if self.min_rating is not None:
+            # Both players must be rated at least min_rating
+            ratings = (parse_rating(headers.get("WhiteElo")), parse_rating(headers.get("BlackElo")))
+            if any(rating is None or rating < self.min_rating for rating in ratings):
+                return False
+
+        if self.min_estimated_seconds is not None:
+            # Estimated duration as Lichess defines it: base time + 40 moves of increment
+            time_control = headers.get("TimeControl", "?")
+            if time_control != "-":  # Correspondence games have no clock and always pass
+                parsed = parse_time_control(time_control)
+                if parsed is None or parsed[0] + 40 * parsed[1] < self.min_estimated_seconds:
+                    return False
+
+        if self.results is not None and headers.get("Result", "*") not in self.results:
+            return False
+        return True
+
+
+# Function to compute a stable 64-bit hash of a game's headers (for Lichess games the Site header alone
+# is unique), the same whichever file, batch or run the game is read in
+def game_hash(headers):
+    text = "\n".join(f"{tag}={value}" for tag, value in sorted(headers.items()))
+    return int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+
+
+# Function to assign a game to the train, val or test split from the hash of its headers, so splits stay
+# stable as the corpus grows. Returns the split code, an index into SPLITS
+def game_split(headers, val_fraction, test_fraction):
+    position = game_hash(headers) / 2 ** 64  # Uniform in [0, 1)
+    if position < test_fraction:
+        return SPLITS.index("test")
+    if position < test_fraction + val_fraction:
+        return SPLITS.index("val")
+    return SPLITS.index("train")
+
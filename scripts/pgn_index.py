@@ -0,0 +1,141 @@
+import mmap
+import os
+import re
+import sys
+import zlib
+
+import chess.pgn
+import numpy as np
+
+INDEX_SUFFIX = ".pgnidx"
+INDEX_MAGIC = int.from_bytes(b"PGNINDEX", "little")
+INDEX_VERSION = 2  # 2: games that start right after movetext are indexed
+HEADER_SIZE = 6  # magic, version, pgn size, pgn mtime_ns, number of games, checksum
+
+# A game starts at a tag line that follows any line that is not a tag line: usually a blank line, but
+# chess.pgn.read_game also starts a new game right after movetext (e.g. after "cat a.pgn b.pgn" where
+# a.pgn ends in a single newline). Group 1 is the start of the tag line
+TAG_LINE = rb"\[[A-Za-z0-9_]+[ \t]+\""
+GAME_START_REGEX = re.compile(rb"(?:\A|\n)(?!" + TAG_LINE + rb")[^\n]*\n(" + TAG_LINE + rb")")
+FIRST_TAG_REGEX = re.compile(rb"\A(?:\xef\xbb\xbf)?\s*\[")
+
+
+# Function to find the byte offset of every game in a PGN file with one pass over the bytes
+def scan_game_offsets(pgn_file):
+    if os.path.getsize(pgn_file) == 0:
+        return np.zeros(0, dtype=np.uint64)
+
+    with open(pgn_file, "rb") as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        offsets, start = [], 0
+        first = FIRST_TAG_REGEX.match(mm)
+        if first:
+            start = first.end() - 1
+            offsets.append(start)
+        offsets.extend(match.start(1) for match in GAME_START_REGEX.finditer(mm, start))
+    return np.array(offsets, dtype=np.uint64)
+
+
+# Function to compute the checksum stored in the index header
+def index_checksum(header_fields, offsets):
+    checksum = zlib.crc32(np.asarray(header_fields, dtype=np.uint64).tobytes())
+    return zlib.crc32(offsets.tobytes(), checksum)
+
+
+# Function to build the sidecar index for a PGN file and save it next to the file
+def build_pgn_index(pgn_file, index_file=None):
+    index_file = index_file or pgn_file + INDEX_SUFFIX
+    stat = os.stat(pgn_file)
+    offsets = scan_game_offsets(pgn_file)
+
+    header_fields = [INDEX_MAGIC, INDEX_VERSION, stat.st_size, stat.st_mtime_ns, len(offsets)]
+    header = np.array(header_fields + [index_checksum(header_fields, offsets)], dtype=np.uint64)
+
+    # Write to a temporary file first so a crash never leaves a truncated index behind
+    tmp_file = index_file + ".tmp"
+    with open(tmp_file, "wb") as f:
+        np.save(f, np.concatenate((header, offsets)))
+    os.replace(tmp_file, index_file)
+    return offsets
+
+
+# Function to read an index file, returning None if it is missing, corrupt or stale
+def read_pgn_index(pgn_file, index_file=None):
+    index_file = index_file or pgn_file + INDEX_SUFFIX
+    if not os.path.exists(index_file):
+        return None
+
+    try:
+        data = np.load(index_file)
+    except (OSError, ValueError):
+        return None
+    if data.dtype != np.uint64 or data.ndim != 1 or len(data) < HEADER_SIZE:
+        return None
+
+    magic, version, size, mtime_ns, num_games, checksum = (int(v) for v in data[:HEADER_SIZE])
+    offsets = data[HEADER_SIZE:]
+    if magic != INDEX_MAGIC or version != INDEX_VERSION or num_games != len(offsets):
+        return None
+    if checksum != index_checksum(data[:HEADER_SIZE - 1], offsets):
+        return None
+
+    # The index is only valid for the exact file it was built from
+    stat = os.stat(pgn_file)
+    if size != stat.st_size or mtime_ns != stat.st_mtime_ns:
+        return None
+    return offsets
+
+
+# Function to load the game offsets of a PGN file, rebuilding the index only when the file changed
+def load_pgn_index(pgn_file, index_file=None):
+    offsets = read_pgn_index(pgn_file, index_file)
+    if offsets is None:
+        print(f"Building game index for {pgn_file}...")
+        offsets = build_pgn_index(pgn_file, index_file)
+    return offsets
+
+
+# Function to position an open PGN file at the start of game k
+def seek_to_game(pgn, offsets, game_number):
+    if game_number >= len(offsets):
+        pgn.seek(0, os.SEEK_END)
+    else:
+        pgn.seek(int(offsets[game_number]))
+
+
+# Function to check an index against python-chess: counts the games chess.pgn.read_headers finds in the file
+# and checks that every indexed offset is where one of them starts. Returns a list of problems (empty if none)
+def verify_pgn_index(pgn_file, offsets):
+    problems = []
+    with open(pgn_file, encoding="utf-8-sig", errors="replace") as f:
+        num_games = 0
+        while chess.pgn.read_headers(f) is not None:
+            num_games += 1
+    if num_games != len(offsets):
+        problems.append(f"{len(offsets)} games indexed but read_headers finds {num_games}")
+
+    with open(pgn_file, "rb") as f:
+        for game_number, offset in enumerate(offsets):
+            f.seek(int(offset))
+            if f.read(1) != b"[":
+                problems.append(f"game {game_number} at byte {int(offset)} does not start with a tag")
+                break
+    return problems
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Build the game index of PGN files.")
+    parser.add_argument("files", nargs="+", help="Uncompressed PGN files")
+    parser.add_argument("--verify", action="store_true", help="Check the index against chess.pgn.read_headers")
+    args = parser.parse_args()
+
+    for pgn_file in args.files:
+        offsets = build_pgn_index(pgn_file)
+        print(f"Indexed {len(offsets)} games in {pgn_file}")
+        if args.verify:
+            problems = verify_pgn_index(pgn_file, offsets)
+            for problem in problems:
+                print(f"MISMATCH {pgn_file}: {problem}")
+            if problems:
+                sys.exit(1)
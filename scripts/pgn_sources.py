@@ -0,0 +1,152 @@
+import bz2
+import gzip
+import io
+import lzma
+import os
+import queue
+import threading
+import zlib
+
+try:
+    import zstandard
+except ImportError:  # .pgn.zst support is optional
+    zstandard = None
+
+DEFAULT_CHUNK_SIZE = 1 << 20  # Bytes decompressed per chunk
+DEFAULT_MAX_CHUNKS = 16  # Chunks buffered ahead of the parser
+FINGERPRINT_BYTES = 1 << 20  # Bytes hashed at the start and at the end of a source file
+
+
+# Function to open a zstd-compressed file as a binary stream
+def open_zstd(path):
+    if zstandard is None:
+        raise ImportError(f"Reading {path} requires the zstandard module (pip install zstandard)")
+    # Dumps may hold several frames (e.g. written in parallel or appended to); read them all
+    return zstandard.ZstdDecompressor().stream_reader(open(path, "rb"), closefd=True, read_across_frames=True)
+
+
+DECOMPRESSORS = {
+    ".gz": lambda path: gzip.open(path, "rb"),
+    ".bz2": lambda path: bz2.open(path, "rb"),
+    ".xz": lambda path: lzma.open(path, "rb"),
+    ".zst": open_zstd,
+}
+
+
+# Function to check whether a PGN path is a compressed dump (and therefore cannot be indexed or seeked)
+def is_compressed(path):
+    return any(path.endswith(suffix) for suffix in DECOMPRESSORS)
+
+
+# Raw stream that decompresses in a background thread and hands chunks to the reader through a bounded
+# queue. The decompressors release the GIL, so decompression overlaps with parsing in the main thread
+class ThreadedDecompressor(io.RawIOBase):
+    def __init__(self, open_binary, path, chunk_size=DEFAULT_CHUNK_SIZE, max_chunks=DEFAULT_MAX_CHUNKS):
+        super().__init__()
+        self.chunks = queue.Queue(max_chunks)
+        self.pending = memoryview(b"")
+        self.finished = False
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.produce, args=(open_binary, path, chunk_size), daemon=True)
+        self.thread.start()
+
+    def produce(self, open_binary, path, chunk_size):
+        try:
+            with open_binary(path) as source:
+                while not self.stopping.is_set():
+                    chunk = source.read(chunk_size)
+                    self.chunks.put(chunk)  # Blocks while the buffer is full
+                    if not chunk:
+                        return
+        except BaseException as error:  # Re-raised in the reading thread
+            self.chunks.put(error)
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            if self.finished:
+                return 0
+            chunk = self.chunks.get()
+            if isinstance(chunk, BaseException):
+                self.finished = True
+                raise chunk
+            if not chunk:
+                self.finished = True
+                return 0
+            self.pending = memoryview(chunk)
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+    def close(self):
+        if not self.closed:
+            # Unblock the producer if it is waiting on a full queue, then let it exit
+            self.stopping.set()
+            while self.thread.is_alive():
+                try:
+                    self.chunks.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+        super().close()
+
+
+# Function to open a PGN file for reading in text mode. Files ending in .gz, .bz2, .xz or .zst are
+# decompressed on the fly (in a background thread when threaded=True), never to disk
+def open_pgn(path, threaded=True):
+    for suffix, open_binary in DECOMPRESSORS.items():
+        if path.endswith(suffix):
+            raw = ThreadedDecompressor(open_binary, path) if threaded else open_binary(path)
+            return io.TextIOWrapper(io.BufferedReader(raw) if threaded else raw, encoding="utf-8")
+    return open(path)
+
+
+# Function to get the key a source file is recorded under in the dataset manifest
+def source_key(path):
+    return os.path.abspath(path)
+
+
+# Function to compute the CRC32 of length bytes of a file starting at offset
+def range_checksum(path, offset, length):
+    with open(path, "rb") as f:
+        f.seek(offset)
+        return f"{zlib.crc32(f.read(length)):08x}"
+
+
+# Function to identify the contents of a source file by its size, modification time and the checksums
+# of its first and last FINGERPRINT_BYTES bytes. Hashing the ends rather than the whole file keeps this
+# cheap for multi-gigabyte dumps while still telling an appended file from a rewritten one
+def source_fingerprint(path):
+    stat = os.stat(path)
+    tail_offset = max(stat.st_size - FINGERPRINT_BYTES, 0)
+    return {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns,
+            "head_crc32": range_checksum(path, 0, FINGERPRINT_BYTES),
+            "tail_crc32": range_checksum(path, tail_offset, stat.st_size - tail_offset)}
+
+
+# Function to get how many games of a source file are already in a dataset, given the "sources" section
+# of its manifest. Returns 0 for new files and None if the file was changed other than by appending games
+def ingested_games(sources, path):
+    record = sources.get(source_key(path))
+    if record is None:
+        return 0
+
+    stat = os.stat(path)
+    if stat.st_size == record["size"] and stat.st_mtime_ns == record["mtime_ns"]:
+        return record["games"]
+
+    # Games were appended if the bytes that were ingested are unchanged
+    size = record["size"]
+    tail_offset = max(size - FINGERPRINT_BYTES, 0)
+    if stat.st_size >= size and record["head_crc32"] == range_checksum(path, 0, min(size, FINGERPRINT_BYTES)) \
+            and record["tail_crc32"] == range_checksum(path, tail_offset, size - tail_offset):
+        return record["games"]
+    return None
+
+
+# Function to build the manifest record stating that the first num_games games of a source are ingested
+def source_record(fingerprint, num_games):
+    return {**fingerprint, "games": num_games}
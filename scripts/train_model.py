@@ -2,16 +2,136 @@ import tensorflow as tf
 from tensorflow.keras.models import Sequential, load_model
 from tensorflow.keras.layers import Dense, Dropout
 import numpy as np
+import argparse
+import json
 import os
 import gc  # Garbage collector
 
+from board_encoding import NUM_FEATURES, PACKED_BYTES, flip_positions, pack_positions, unpack_positions
+from dataset_shards import MANIFEST_NAME, ShardedArray, load_manifest, open_dataset, shard_split
+from move_vocab import FLIP_MOVES, is_fixed_move_dict, unpack_legal_masks
+
+# Keras Sequence that reads the given rows of X and y one batch at a time, so X and y can be
+# memory-mapped (or sharded) arrays larger than RAM. Bit-packed positions are unpacked per batch.
+# With soft_targets=(move_labels, move_counts, num_classes) from a deduplicated dataset, the targets
+# are the normalized move distributions instead of y.
+# With flip_augment=True every row is also served color-flipped (mirrored vertically, colors swapped,
+# moves mirrored), doubling the rows per epoch without storing anything extra.
+# With the bit-packed legal-move masks of the rows, each target row is [label, legal mask] for the masked loss
+class BatchSequence(tf.keras.utils.Sequence):
+    def __init__(self, X, y, rows, batch_size=512, shuffle=True, soft_targets=None, flip_augment=False, legal=None):
+        super().__init__()
+        self.X = X
+        self.y = y
+        self.soft_targets = soft_targets
+        self.legal = legal
+        self.packed = X.shape[1] == PACKED_BYTES
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        # Flipped copies of the rows are numbered from len(X) upwards
+        rows = np.array(rows)
+        self.order = np.concatenate((rows, rows + len(X))) if flip_augment else rows
+        self.on_epoch_end()
+
+    def __len__(self):
+        return -(-len(self.order) // self.batch_size)  # Ceiling division
+
+    def __getitem__(self, idx):
+        order = self.order[idx * self.batch_size:(idx + 1) * self.batch_size]
+        # Sorted rows keep the reads as sequential as possible
+        order = order[np.argsort(order % len(self.X), kind="stable")]
+        rows, flipped = order % len(self.X), order >= len(self.X)
+        X_batch = np.asarray(self.X[rows])
+        if flipped.any():
+            X_batch[flipped] = flip_positions(X_batch[flipped])  # Flipped before unpacking, on 96-byte rows
+        X_batch = unpack_positions(X_batch) if self.packed else np.asarray(X_batch, dtype=np.float32)
+        if self.soft_targets is not None:
+            targets = soft_target_batch(rows, *self.soft_targets)
+            targets[flipped] = targets[flipped][:, FLIP_MOVES]
+            return X_batch, targets
+        y_batch = np.asarray(self.y[rows])
+        y_batch = np.where(flipped, FLIP_MOVES[y_batch], y_batch)
+        if self.legal is not None:
+            masks = unpack_legal_masks(self.legal[rows])
+            masks[flipped] = masks[flipped][:, FLIP_MOVES]
+            return X_batch, np.column_stack((y_batch, masks)).astype(np.float32)
+        return X_batch, y_batch
+
+    def on_epoch_end(self):
+        if self.shuffle:
+            np.random.shuffle(self.order)
+
+# Function to build dense move distributions for rows of a deduplicated dataset from its move counts
+def soft_target_batch(rows, move_labels, move_counts, num_classes):
+    labels = np.asarray(move_labels[rows])
+    counts = np.asarray(move_counts[rows], dtype=np.float32)
+    targets = np.zeros((len(rows), num_classes), dtype=np.float32)
+    batch_rows, slots = np.nonzero(labels >= 0)
+    targets[batch_rows, labels[batch_rows, slots]] = counts[batch_rows, slots]
+    return targets / np.maximum(targets.sum(axis=1, keepdims=True), 1)
+
+# Loss for targets carrying legal-move masks (rows of [label, legal mask], see BatchSequence). The predicted
+# distribution is renormalized over the legal moves, so no probability mass is spent on illegal moves
+def masked_sparse_categorical_crossentropy(y_true, y_pred):
+    legal_pred = y_pred * y_true[:, 1:]
+    legal_pred = legal_pred / tf.maximum(tf.reduce_sum(legal_pred, axis=1, keepdims=True), 1e-12)
+    return tf.keras.losses.sparse_categorical_crossentropy(tf.cast(y_true[:, 0], tf.int32), legal_pred)
+
+# Accuracy of the most likely legal move, for targets carrying legal-move masks
+def legal_accuracy(y_true, y_pred):
+    predicted = tf.argmax(y_pred * y_true[:, 1:], axis=1)
+    return tf.cast(tf.equal(predicted, tf.cast(y_true[:, 0], tf.int64)), tf.float32)
+
+# Function to compute the top-1 accuracy of a model over all moves and over the legal moves only,
+# from the stored legal-move masks (no python-chess calls)
+def evaluate_legal_accuracy(model, X, y, legal, batch_size=512):
+    correct = legal_correct = 0
+    for X_batch, targets in BatchSequence(X, y, np.arange(len(X)), batch_size, shuffle=False, legal=legal):
+        predictions = model.predict(X_batch, verbose=0)
+        labels, masks = targets[:, 0].astype(np.int64), targets[:, 1:] > 0
+        correct += np.sum(predictions.argmax(axis=1) == labels)
+        legal_correct += np.sum(np.where(masks, predictions, -1).argmax(axis=1) == labels)
+    return correct / len(X), legal_correct / len(X)
+
+# Function to convert labels saved as one-hot rows by older versions into int16 move indices
+def labels_from_legacy(y):
+    if y.ndim == 2:
+        y = np.argmax(y, axis=1)
+    return y if y.dtype == np.int16 else y.astype(np.int16)
+
+# Function to memory-map positions from a directory, preferring the bit-packed file if it exists
+def load_positions(directory, name="X"):
+    packed_path = f"{directory}/{name}_packed.npy"
+    if os.path.exists(packed_path):
+        return np.load(packed_path, mmap_mode="r")
+    return np.load(f"{directory}/{name}.npy", mmap_mode="r")
+
 # Function to check if a model exists and load it, otherwise create a new one
-def load_or_create_model(input_shape, num_classes, model_path="data/chess_ai_model.h5"):
+# Soft targets are move distributions, so they need the dense categorical loss; targets with legal-move
+# masks use the masked loss
+def load_or_create_model(input_shape, num_classes, model_path="data/chess_ai_model.h5", soft_targets=False,
+                         legal_masks=False):
+    loss = 'categorical_crossentropy' if soft_targets else 'sparse_categorical_crossentropy'
+    metrics = ['accuracy']
+    if legal_masks:
+        loss, metrics = masked_sparse_categorical_crossentropy, [legal_accuracy]
+    model = None
     if os.path.exists(model_path):
         print("Loading existing model...")
-        model = load_model(model_path)
+        model = load_model(model_path, compile=False)  # Always recompiled below
+
+        # Models trained on an older move vocabulary cannot be reused for the current labels
+        if model.output_shape[-1] != num_classes:
+            print(f"Existing model predicts {model.output_shape[-1]} moves but the data uses {num_classes}, "
+                  "creating a new model...")
+            model = None
+        else:
+            # Recompile with the loss matching the targets (models saved before used a one-hot loss)
+            model.compile(optimizer='adam', loss=loss, metrics=metrics)
     else:
         print("No existing model found, creating a new model...")
+
+    if model is None:
         model = Sequential([
             Dense(1024, input_dim=input_shape, activation='relu'),
             Dropout(0.3),
@@ -19,35 +139,73 @@ def load_or_create_model(input_shape, num_classes, model_path="data/chess_ai_mod
             Dropout(0.3),
             Dense(num_classes, activation='softmax')  # Output layer with softmax
         ])
-        model.compile(optimizer='adam', loss='categorical_crossentropy', metrics=['accuracy'])
+        model.compile(optimizer='adam', loss=loss, metrics=metrics)
     return model
 
-# Function to load and combine old and new data
-def load_and_combine_data(data_dir="data", new_data_dir=None):
-    # Load existing data
-    X_old = np.load(f"{data_dir}/X.npy")
-    y_old = np.load(f"{data_dir}/y.npy")
+# Function to get the number of move classes from the dataset manifest or the saved move dictionary
+def load_num_classes(y, data_dir="data", dataset_dir=None):
+    manifest = load_manifest(dataset_dir or f"{data_dir}/dataset")
+    if manifest["shards"]:
+        return manifest["num_classes"]
+
+    move_dict_path = f"{data_dir}/move_dict.json"
+    if os.path.exists(move_dict_path):
+        with open(move_dict_path) as f:
+            return len(json.load(f))
+    return int(np.max(y[:])) + 1
+
+# Function to open one split of a sharded dataset, returning None if the dataset has no shards of that split
+def load_split(dataset_dir, split, names=("X", "y")):
+    if not any(shard_split(shard) == split for shard in load_manifest(dataset_dir)["shards"]):
+        return None
+    return open_dataset(dataset_dir, names, split=split)
+
+# Function to refuse X.npy/y.npy labels from older versions once move_dict.json holds the fixed vocabulary:
+# they are numbered by the batch-grown dictionary it replaced, so they would be paired with the wrong moves
+def check_legacy_labels(data_dir, dataset_dir):
+    move_dict_path = f"{data_dir}/move_dict.json"
+    if os.path.exists(move_dict_path):
+        with open(move_dict_path) as f:
+            if is_fixed_move_dict(json.load(f)):
+                raise SystemExit(f"Labels saved as y.npy by older versions use an old move_dict.json, but {move_dict_path} holds "
+                                 f"the fixed move vocabulary; convert them with "
+                                 f"'python scripts/move_vocab.py {dataset_dir} {move_dict_path}'")
+
+# Function to load and combine old and new data. Positions are memory-mapped and combined into
+# virtual arrays, so nothing is copied and datasets larger than RAM can be used
+def load_and_combine_data(data_dir="data", new_data_dir=None, dataset_dir=None):
+    # Load existing data: the training shards of the sharded dataset if there is one,
+    # otherwise X.npy/y.npy from older versions
+    dataset_dir = dataset_dir or f"{data_dir}/dataset"
+    if os.path.exists(f"{dataset_dir}/{MANIFEST_NAME}"):
+        X_old, y_old = open_dataset(dataset_dir, split="train")
+    else:
+        check_legacy_labels(data_dir, dataset_dir)
+        X_old = load_positions(data_dir)
+        y_old = labels_from_legacy(np.load(f"{data_dir}/y.npy", mmap_mode="r"))
     
     print(f"Shape of old X: {X_old.shape}")
     print(f"Shape of old y: {y_old.shape}")
     
     # If new data exists, concatenate with the old data
     if new_data_dir:
-        X_new = np.load(f"{new_data_dir}/new_X.npy")
-        y_new = np.load(f"{new_data_dir}/new_y.npy")
+        check_legacy_labels(data_dir, dataset_dir)
+        X_new = load_positions(new_data_dir, "new_X")
+        y_new = labels_from_legacy(np.load(f"{new_data_dir}/new_y.npy", mmap_mode="r"))
         
         print(f"Shape of new X: {X_new.shape}")
         print(f"Shape of new y: {y_new.shape}")
         
-        # Concatenate old and new data
-        X_combined = np.concatenate((X_old, X_new), axis=0)
-        y_combined = np.concatenate((y_old, y_new), axis=0)
+        # Pack the dense side if only one of the two datasets is bit-packed
+        if X_old.shape[1] != X_new.shape[1]:
+            X_old, X_new = (pack_positions(X[:]) if X.shape[1] != PACKED_BYTES else X for X in (X_old, X_new))
+
+        # Present old and new data as one array without concatenating them
+        X_combined = ShardedArray([X_old, X_new])
+        y_combined = ShardedArray([y_old, y_new])
         
         print(f"Shape of combined X: {X_combined.shape}")
         print(f"Shape of combined y: {y_combined.shape}")
-        
-        # Free memory
-        del X_new, y_new
     else:
         X_combined, y_combined = X_old, y_old
     
@@ -55,21 +213,72 @@ def load_and_combine_data(data_dir="data", new_data_dir=None):
 
 # Main training process
 def main():
+    parser = argparse.ArgumentParser(description="Train the chess move prediction model.")
+    parser.add_argument("--dataset-dir", default=None, help="Sharded dataset to train on (default: data/dataset)")
+    parser.add_argument("--soft-targets", action="store_true",
+                        help="Train on the move counts of a deduplicated dataset (see dedup_positions.py)")
+    parser.add_argument("--legal-masks", action="store_true",
+                        help="Train with a loss restricted to the legal moves (needs a dataset built with --legal-masks)")
+    parser.add_argument("--flip-augment", action="store_true",
+                        help="Also train on every position color-flipped, doubling the training data")
+    args = parser.parse_args()
+    if args.soft_targets and args.legal_masks:
+        parser.error("--soft-targets and --legal-masks cannot be combined")
+
     data_dir = "data"  # Directory for old data
     new_data_dir = None  # Update this if new data is added, e.g., "new_data"
+    dataset_dir = args.dataset_dir or f"{data_dir}/dataset"
 
     # Load and combine old and new data
-    X, y = load_and_combine_data(data_dir, new_data_dir)
+    X, y = load_and_combine_data(data_dir, new_data_dir, dataset_dir)
     
     # Get the input shape and number of output classes
-    input_shape = X.shape[1]
-    num_classes = y.shape[1]
+    packed = X.shape[1] == PACKED_BYTES
+    input_shape = NUM_FEATURES if packed else X.shape[1]
+    num_classes = load_num_classes(y, data_dir, dataset_dir)
+
+    soft_targets = val_soft_targets = None
+    if args.soft_targets:
+        soft_targets = (*open_dataset(dataset_dir, ("move_labels", "move_counts"), split="train"), num_classes)
+        val_soft_parts = load_split(dataset_dir, "val", ("move_labels", "move_counts"))
+        if val_soft_parts is not None:
+            val_soft_targets = (*val_soft_parts, num_classes)
+
+    legal = val_legal = None
+    if args.legal_masks:
+        legal, = open_dataset(dataset_dir, ("legal",), split="train")
+        val_legal_parts = load_split(dataset_dir, "val", ("legal",))
+        if val_legal_parts is not None:
+            val_legal, = val_legal_parts
     
     # Load the existing model or create a new one
-    model = load_or_create_model(input_shape, num_classes)
+    model = load_or_create_model(input_shape, num_classes, soft_targets=args.soft_targets, legal_masks=args.legal_masks)
     
-    # Train the model on the combined dataset
-    history = model.fit(X, y, epochs=10, batch_size=512, validation_split=0.1)
+    # Validate on the validation split written at preprocessing time, which holds whole games that are never
+    # trained on. Datasets without one hold out their last 10% of rows instead
+    validation = load_split(dataset_dir, "val")
+    if validation is not None:
+        X_val, y_val = validation
+        print(f"Shape of validation X: {X_val.shape}")
+        train_batches = BatchSequence(X, y, np.arange(len(X)), batch_size=512, soft_targets=soft_targets,
+                                      flip_augment=args.flip_augment, legal=legal)
+        val_batches = BatchSequence(X_val, y_val, np.arange(len(X_val)), batch_size=512, shuffle=False,
+                                    soft_targets=val_soft_targets, legal=val_legal)
+    else:
+        split = int(len(X) * 0.9)
+        train_batches = BatchSequence(X, y, np.arange(split), batch_size=512, soft_targets=soft_targets,
+                                      flip_augment=args.flip_augment, legal=legal)
+        val_batches = BatchSequence(X, y, np.arange(split, len(X)), batch_size=512, shuffle=False,
+                                    soft_targets=soft_targets, legal=legal)
+    history = model.fit(train_batches, validation_data=val_batches, epochs=10)
+
+    # Report plain and legal-restricted accuracy on the held-out splits
+    if args.legal_masks:
+        for split in ("val", "test"):
+            held_out = load_split(dataset_dir, split, ("X", "y", "legal"))
+            if held_out is not None:
+                accuracy, legal_only = evaluate_legal_accuracy(model, *held_out)
+                print(f"{split}: accuracy {accuracy:.4f}, legal-move accuracy {legal_only:.4f}")
     
     # Free memory after training
     del X, y